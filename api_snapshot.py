@@ -0,0 +1,102 @@
+import json
+import logging
+import threading
+import time
+
+import requests
+
+
+class ApiSnapshot:
+    """
+    In-memory snapshot of the limits table served by the external API.
+    The whole table is downloaded at most once per `ttl` seconds over a pooled session and every
+    cell lookup is served from the parsed rows. Refreshes are conditional (ETag / Last-Modified),
+    and when a refresh fails the last good snapshot keeps being served.
+    With `record_path` every new table is appended to a JSON lines file that replay.py can replay.
+    """
+
+    def __init__(self, url, auth=None, ttl=60, timeout=10, session=None, on_error=None, clock=time.monotonic,
+                 metrics=None, record_path=None):
+        self.url = url
+        self.auth = auth
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.on_error = on_error  # called once per failed refresh with the exception
+        self.clock = clock
+        self.metrics = metrics  # optional Metrics registry, every request is timed as endpoint "limits_api"
+        self.record_path = record_path  # JSON lines file every new table is appended to, for replay.py
+        self.rows = None
+        self.fetched_at = None  # time of the last successful refresh
+        self.checked_at = None  # time of the last refresh attempt
+        self.last_error = None
+        self._etag = None
+        self._last_modified = None
+        self._lock = threading.Lock()
+
+    def is_stale(self):
+        return self.checked_at is None or self.clock() - self.checked_at > self.ttl
+
+    def refresh(self, force=False):
+        # Download the table if the snapshot is older than ttl (or always with force), returns the rows.
+        with self._lock:
+            if not force and not self.is_stale():
+                return self.rows
+            headers = {}
+            if self.rows is not None:
+                if self._etag:
+                    headers['If-None-Match'] = self._etag
+                if self._last_modified:
+                    headers['If-Modified-Since'] = self._last_modified
+            self.checked_at = self.clock()
+            started = time.perf_counter()
+            response = None
+            try:
+                response = self.session.get(self.url, auth=self.auth, headers=headers, timeout=self.timeout)
+                if response.status_code == 304:
+                    logging.debug("API snapshot not modified")
+                else:
+                    response.raise_for_status()  # This will generate an exception for responses that are not code 2xx
+                    self.rows = response.json().get("rows", [])
+                    self._etag = response.headers.get('ETag')
+                    self._last_modified = response.headers.get('Last-Modified')
+                    logging.debug(f"API snapshot refreshed, {len(self.rows)} rows")
+                    if self.record_path:
+                        self._record(self.rows)
+                self.fetched_at = self.clock()
+                self.last_error = None
+                self._observe(started, response)
+            except (requests.RequestException, ValueError) as e:
+                self._observe(started, response, e)
+                self.last_error = e
+                if self.rows is not None:
+                    logging.warning(f"API refresh failed, using snapshot from "
+                                    f"{self.clock() - self.fetched_at:.0f} s ago: {e}")
+                else:
+                    logging.error(f"API refresh failed and no snapshot is available: {e}")
+                if self.on_error:
+                    self.on_error(e)
+            return self.rows
+
+    def _record(self, rows):
+        # Append {"time": unix time, "rows": rows}; a recording problem never stops the control.
+        try:
+            with open(self.record_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"time": time.time(), "rows": rows}) + "\n")
+        except OSError as e:
+            logging.error(f"Recording the limits table to {self.record_path} failed: {e}")
+
+    def _observe(self, started, response, error=None):
+        if self.metrics is not None:
+            self.metrics.observe_http("limits_api", time.perf_counter() - started,
+                                      len(response.content) if response is not None else 0, error)
+
+    def cell(self, row_val, data_val):
+        # Return rows[row_val][data_val] from the current snapshot, or None when it is missing.
+        rows = self.refresh()
+        if rows is None:
+            return None
+        return rows[row_val][data_val] if row_val < len(rows) and data_val < len(rows[row_val]) else None
+
+    def close(self):
+        self.session.close()
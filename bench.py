@@ -0,0 +1,127 @@
+"""
+Benchmarks of the control paths against the local simulator, no hardware or network needed.
+
+    python bench.py --gateways 2 --slaves 8 --latency 0.02 --jitter 0.005 --iterations 50
+
+Reports p50/p95/p99 latency per operation, slaves per second and Modbus round trips per call.
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+
+from control_core import ControlCore, load_config
+from notifications import MemoryBackend, NotificationDispatcher
+from simulator import LimitsApiStub, SimulatedGateway, default_limits_rows
+
+
+def percentile(samples, fraction):
+    # Nearest-rank percentile of a non-empty list.
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+class Benchmark:
+    def __init__(self, gateways=1, slaves=8, concurrency=4, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 api_latency=0.0):
+        self.gateways = [SimulatedGateway(slaves, latency=latency, jitter=jitter, failure_rate=failure_rate).start()
+                         for _ in range(gateways)]
+        self.api = LimitsApiStub(default_limits_rows(), latency=api_latency).start()
+        config = load_config()
+        config.update({
+            "gateways": [{"name": f"sim{index}", "host": gateway.host, "port": gateway.port,
+                          # The table has 8 zone rows (9 and 10 are the grid), larger gateways reuse them
+                          "slaves": [{"id": slave_id, "name": f"Module {slave_id}",
+                                      "api_row": (slave_id - 1) % 8 + 1} for slave_id in range(1, slaves + 1)]}
+                         for index, gateway in enumerate(self.gateways)],
+            "modbus_concurrency": concurrency,
+            "api_url": self.api.url,
+            "api_ttl": 3600,  # refreshed explicitly once per measured cycle
+        })
+        self.core = ControlCore(config)
+        self.core.notifier = NotificationDispatcher(MemoryBackend())  # no messages from benchmarks
+        self.slave_count = gateways * slaves
+        self.results = {}
+
+    def round_trips(self):
+        return sum(gateway.take_request_count() for gateway in self.gateways)
+
+    def measure(self, name, operation, iterations):
+        # Run operation() `iterations` times, recording latency and Modbus round trips.
+        operation()  # warm up: connections, event loop threads
+        self.round_trips()
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            operation()
+            samples.append(time.perf_counter() - start)
+        self.results[name] = {
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p95_ms": percentile(samples, 0.95) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+            "mean_ms": statistics.fmean(samples) * 1000,
+            "slaves_per_s": self.slave_count / statistics.fmean(samples),
+            "round_trips": self.round_trips() / iterations,
+        }
+
+    def run(self, iterations):
+        all_keys = [slave.key for slave in self.core.fleet.slaves]
+        percentage = iter(range(10 ** 9))
+
+        # A new value every call, otherwise the device cache would suppress the writes
+        self.measure("apply_percentage_to_all",
+                     lambda: self.core.apply_percentages(dict.fromkeys(all_keys, 20 + next(percentage) % 80)),
+                     iterations)
+        self.measure("update_power_display", lambda: self.core.fleet.read_all(("power",)), iterations)
+
+        def auto_cycle():
+            self.core.fleet.take_suppressed()
+            for gateway in self.core.fleet.gateways.values():
+                gateway.cache.invalidate()  # steady state writes are suppressed, measure the full cycle
+            self.core.api_snapshot.refresh(force=True)  # one table download per cycle
+            self.core.apply_percentages(self.core.compute_percentages())
+
+        self.measure("auto_control_cycle", auto_cycle, iterations)
+        return self.results
+
+    def close(self):
+        self.core.close()
+        self.api.stop()
+        for gateway in self.gateways:
+            gateway.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Modbus control paths against the simulator")
+    parser.add_argument("--gateways", type=int, default=1)
+    parser.add_argument("--slaves", type=int, default=8, help="slaves per gateway")
+    parser.add_argument("--concurrency", type=int, default=4, help="connections per gateway")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds per Modbus request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+- seconds added to the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of failing Modbus requests")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per limits API request")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    bench = Benchmark(args.gateways, args.slaves, args.concurrency, args.latency, args.jitter, args.failure_rate,
+                      args.api_latency)
+    try:
+        results = bench.run(args.iterations)
+    finally:
+        bench.close()
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.gateways} gateway(s) x {args.slaves} slaves, latency {args.latency * 1000:.1f} ms "
+          f"+- {args.jitter * 1000:.1f} ms, {args.iterations} iterations")
+    print(f"{'operation':<26}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'slaves/s':>10}{'round trips':>13}")
+    for name, result in results.items():
+        print(f"{name:<26}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+              f"{result['slaves_per_s']:>10.1f}{result['round_trips']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
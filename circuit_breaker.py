@@ -0,0 +1,57 @@
+import logging
+import random
+import time
+
+
+class CircuitBreaker:
+    """
+    Failure tracking of one slave (or one gateway connection). After `failure_threshold`
+    consecutive failures the breaker opens: callers skip the unit and a background probe tests it
+    again at next_probe_at. The probe delay doubles after every failed probe, from base_delay up
+    to max_delay, with +-jitter so that many units do not retry in lockstep.
+    """
+
+    def __init__(self, name, failure_threshold=3, base_delay=5, max_delay=300, jitter=0.2, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.clock = clock
+        self.failures = 0
+        self.is_open = False
+        self.next_probe_at = None
+        self._probes = 0
+
+    def allow(self):
+        return not self.is_open
+
+    def probe_due(self, now=None):
+        return self.is_open and (self.clock() if now is None else now) >= self.next_probe_at
+
+    def record_success(self):
+        if self.is_open:
+            logging.info(f"{self.name} answers again, circuit closed")
+        self.failures = 0
+        self.is_open = False
+        self.next_probe_at = None
+        self._probes = 0
+
+    def record_failure(self):
+        # Returns True when this failure opened the breaker.
+        self.failures += 1
+        if self.is_open:
+            self._schedule_probe()
+            return False
+        if self.failures >= self.failure_threshold:
+            self.is_open = True
+            self._schedule_probe()
+            logging.warning(f"{self.name} failed {self.failures} times in a row, circuit open, "
+                            f"next probe in {self.next_probe_at - self.clock():.1f} s")
+            return True
+        return False
+
+    def _schedule_probe(self):
+        delay = min(self.max_delay, self.base_delay * 2 ** self._probes)
+        self.next_probe_at = self.clock() + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self._probes += 1
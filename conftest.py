@@ -0,0 +1 @@
+# Marks the repository root for pytest, so the tests import the top-level modules with a plain `pytest`.
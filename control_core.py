@@ -0,0 +1,350 @@
+"""
+Control logic shared by the Tk application and the headless service: Modbus access to the
+gateway fleet, the limits API and the automatic dimming loop. Nothing here imports tkinter, and
+requests is only imported when the API or WhatsApp is used for the first time.
+"""
+import json
+import logging
+import threading
+import time
+
+from curves import DimmingCurve
+from fleet import Fleet
+from metrics import Metrics, MetricsServer
+from modbus_engine import CircuitOpenError
+from power_store import PowerStore
+from ramp import RampEngine
+from scheduler import AdaptiveScheduler
+
+DEFAULT_CONFIG = {
+    # Gateways with their slaves in display order; api_row is the row of the limits API driving the slave
+    "gateways": [
+        {"name": "Greenhouse", "host": "192.168.0.1",  # use here your modbus module IP address
+         "slaves": [{"id": 3, "name": "Module 7", "api_row": 7},
+                    {"id": 1, "name": "Module 5", "api_row": 5},
+                    {"id": 6, "name": "Module 3", "api_row": 3},
+                    {"id": 5, "name": "Module 1", "api_row": 1},
+                    {"id": 4, "name": "Module 8", "api_row": 8},
+                    {"id": 2, "name": "Module 6", "api_row": 6},
+                    {"id": 7, "name": "Module 4", "api_row": 4},
+                    {"id": 8, "name": "Module 2", "api_row": 2}]},
+    ],
+    "modbus_port": 502,  # defaults for gateways that do not set their own
+    "modbus_concurrency": 4,  # max slave sequences in flight at once per gateway
+    "modbus_timeout": 3,  # seconds per request attempt
+    "modbus_retries": 1,
+    "slave_deadline": 10,  # seconds for the whole command sequence of one slave
+    "breaker_threshold": 3,  # unanswered commands in a row before a slave is skipped and probed in the background
+    "probe_max_delay": 300,  # longest backoff between two probes of a skipped slave
+    "mflux": 1000,  # default flux value
+    "base_percentages": [100, 80, 60, 40, 20],  # Base interpolate values
+    "curve_shape": "linear",  # linear, smoothstep or step between the limits
+    "curve_clamps": [100, 20],  # percentage below the first and above the last limit
+    "curve_lut": False,  # precompute every zone's curve for integer PAR values
+    "cycle_seconds": 300,  # every slave is rewritten at least this often by auto control
+    "poll_seconds": 15,  # how often auto control checks the limits API for changes
+    "par_threshold": 10,  # PAR change of a zone that is worth a recompute
+    "hysteresis_percent": 2,  # smaller brightness changes are not written
+    "min_dwell_seconds": 60,  # a slave keeps its brightness at least this long, unless the grid limit is hit
+    "breach_margin": 100,  # kW below the import limit at which the brightness is reduced
+    "breach_factor": 0.9,  # brightness multiplier while the import/export limit is exceeded
+    "ramp_seconds": 10,  # brightness changes fade over this time, 0 jumps; grid limit breaches always jump
+    "ramp_writes_per_second": 20,  # budget of intermediate fade writes per gateway
+    "cache_ttl": 900,  # how long known register values are trusted
+    "api_url": "http://yourapiconnection.example",  # use your api data
+    "api_auth": ["login", "password"],
+    "api_ttl": 60,
+    "api_record_path": None,  # append every new limits table to this JSON lines file, for replay.py
+    "phone": "+48123456789",  # use here your phone number
+    "text": "Power guardian reduced brightness: grid limit exceeded",  # your message
+    "recovery_text": "Power guardian: grid back under the limit, brightness restored",
+    "api_key": "1234567",  # use here your API key
+    "notification_backend": "whatsapp",  # or "log" to only log the alerts
+    "notification_interval": 60,  # minimum seconds between two messages
+    "power_store_path": None,  # directory of the power history, None disables recording
+    "power_poll_seconds": 60,  # how often the power of all slaves is read
+    "metrics_port": None,  # serve Prometheus metrics on http://metrics_host:metrics_port/metrics, None disables
+    "metrics_host": "127.0.0.1",
+}
+
+
+def load_config(path=None):
+    """
+    Return DEFAULT_CONFIG updated with the values of the JSON file at `path`.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            config.update(json.load(f))
+    return config
+
+
+class ControlCore:
+    def __init__(self, config=None, fleet=None, api_snapshot=None):
+        # fleet and api_snapshot replace the Modbus gateways and the limits API, e.g. by the replay stand-ins
+        self.config = config or load_config()
+        self.mflux = self.config["mflux"]
+        self.base_percentages = self.config["base_percentages"]
+        below, above = self.config.get("curve_clamps", (100, 20))
+        self.curve = DimmingCurve(self.base_percentages, below=below, above=above,
+                                  shape=self.config.get("curve_shape", "linear"))
+        self._curve_table = None  # lookup table of the current zone limits when curve_lut is set
+        self.metrics = Metrics()  # latency and error counts of every Modbus and HTTP call
+        # One pooled connection per gateway
+        self.fleet = fleet if fleet is not None else Fleet.from_config(self.config, metrics=self.metrics)
+        self.ramps = RampEngine(self.fleet, writes_per_second=self.config["ramp_writes_per_second"])
+        self.metrics_server = None
+        self.power_store = None
+        if self.config.get("power_store_path"):
+            self.power_store = PowerStore(self.config["power_store_path"])
+        if self.config.get("metrics_port") is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.config.get("metrics_host", "127.0.0.1"),
+                                                self.config["metrics_port"]).start()
+
+        # Set up the Whatsapp parameters
+        self.phone = self.config["phone"]
+        self.text = self.config["text"]
+        self.api_key = self.config["api_key"]
+        self._notifier = None
+
+        self.on_api_error = None  # called with the exception when the limits API cannot be reached
+        self._api_snapshot = api_snapshot
+        self.auto_control = False
+        self.auto_control_counter = 0
+        self._stop_event = threading.Event()
+        self._power_stop_event = threading.Event()
+
+    @property
+    def api_snapshot(self):
+        # Limits table downloaded from the external program, created on first use.
+        if self._api_snapshot is None:
+            from api_snapshot import ApiSnapshot
+            self._api_snapshot = ApiSnapshot(self.config["api_url"], auth=tuple(self.config["api_auth"]),
+                                             ttl=self.config["api_ttl"], metrics=self.metrics,
+                                             on_error=lambda e: self.on_api_error and self.on_api_error(e),
+                                             record_path=self.config.get("api_record_path"))
+        return self._api_snapshot
+
+    def fetch_and_parse(self, row_val: int, data_val: int):
+        """
+        Return one cell of the limits table downloaded from the external program by API.
+        The table is fetched once per snapshot ttl and every cell is served from memory,
+        falling back to the last good snapshot when the API cannot be reached.
+        """
+        return self.api_snapshot.cell(row_val, data_val)
+
+    @property
+    def notifier(self):
+        # Background sender of the power guardian alerts, created on first use.
+        if self._notifier is None:
+            from notifications import CallMeBotBackend, LogBackend, NotificationDispatcher
+            if self.config["notification_backend"] == "log":
+                backend = LogBackend()
+            else:
+                backend = CallMeBotBackend(self.phone, self.api_key)
+            self._notifier = NotificationDispatcher(backend, min_interval=self.config["notification_interval"],
+                                                    metrics=self.metrics)
+        return self._notifier
+
+    @notifier.setter
+    def notifier(self, dispatcher):
+        self._notifier = dispatcher
+
+    def notify_breach(self, breach):
+        # Queue one alert per grid limit breach and a message when it is over, never blocks.
+        if breach:
+            self.notifier.alert("grid_limit", self.text)
+        elif self._notifier is not None:
+            self._notifier.recover("grid_limit", self.config["recovery_text"])
+
+    def evaluate_zones(self):
+        """
+        Read the current limits table and evaluate the brightness of every slave.
+        Returns (percentages, zone_inputs, breach): {key: percentage}, {key: (PAR, limits)} and whether the
+        grid import/export limit is exceeded (the percentages are then reduced), or None without limits data.
+        """
+        # One download of the limits table per cycle, all cells below are read from it
+        if self.api_snapshot.refresh() is None:
+            return None
+        linear_import = self.fetch_and_parse(9, 1)
+        linear_export = self.fetch_and_parse(10, 1)
+        linear_import_limit = float(self.fetch_and_parse(9, 3).replace(',', '.')) * 1000  # change MW value to kW
+        linear_export_limit = float(self.fetch_and_parse(10, 3).replace(',', '.')) * 1000  # change MW value to kW
+
+        # Check conditions to adjust settings before processing slaves
+        breach = (linear_import > linear_import_limit - self.config["breach_margin"]
+                  or linear_export > linear_export_limit)
+
+        # All zones are evaluated in one pass over the curve
+        slaves = self.fleet.slaves
+        limits = [[int(self.fetch_and_parse(slave.api_row, i)) for i in range(2, 7)] for slave in slaves]
+        par_values = [int(self.fetch_and_parse(slave.api_row, 1)) for slave in slaves]
+        values = self.evaluate_curve(par_values, limits)
+        if breach:
+            values = values * self.config["breach_factor"]  # reduce the percentage of all slaves
+
+        percentages = {}
+        zone_inputs = {}
+        for slave, par_value, zone_limits, percentage in zip(slaves, par_values, limits, values.tolist()):
+            percentages[slave.key] = int(percentage)
+            zone_inputs[slave.key] = (par_value, zone_limits)
+            logging.debug(f"Slave: {slave.name} ({slave.gateway.name}/{slave.slave_id}), PAR: {par_value}, "
+                          f"percentage: {percentage}")
+        return percentages, zone_inputs, breach
+
+    def compute_percentages(self):
+        """
+        Compute the brightness of every slave for one cycle from the current limits table.
+        Returns {(gateway name, slave id): percentage}, or None when no limits data is available.
+        """
+        evaluated = self.evaluate_zones()
+        if evaluated is None:
+            return None
+        percentages, zone_inputs, breach = evaluated
+        self.notify_breach(breach)
+        return percentages
+
+    def evaluate_curve(self, par_values, limits):
+        # Percentages of all zones as a NumPy array, through the zone lookup table when curve_lut is set.
+        if not self.config.get("curve_lut"):
+            return self.curve.evaluate(par_values, limits)
+        if self._curve_table is None or not self._curve_table.matches(limits):
+            self._curve_table = self.curve.compile(limits)  # the limits changed, rebuild the table
+        return self._curve_table.evaluate(par_values)
+
+    def apply_percentages(self, percentages, ramp_seconds=0, on_results=None):
+        """
+        Apply {key: percentage} on all gateways in parallel, returns {key: SlaveResult}, also passed to
+        on_results(). With ramp_seconds the slaves fade to the new brightness and the results are those of
+        the first step.
+        """
+        slave_flux = {key: int(percentage * self.mflux / 100) for key, percentage in percentages.items()}
+        if ramp_seconds > 0:
+            results = self.ramps.start(slave_flux, ramp_seconds)
+        else:
+            self.ramps.cancel(slave_flux)
+            results = self.fleet.apply_flux_all(slave_flux)
+        logging.info(f"{self.fleet.take_suppressed()} redundant writes suppressed")
+        if self.power_store is not None:
+            self.power_store.record_results(results)
+        if on_results is not None:
+            on_results(results)
+        return results
+
+    def read_power(self, keys=None):
+        # Read the power of the given slaves (default all) and record it, returns {key: SlaveResult}.
+        results = self.fleet.read_all(("power",), keys)
+        if self.power_store is not None:
+            self.power_store.record_results(results)
+        return results
+
+    def start_power_polling(self, read=None):
+        # Call read() (default read_power on the polling thread) every power_poll_seconds in a daemon thread.
+        read = read or self.read_power
+        self._power_stop_event = stop_event = threading.Event()
+
+        def poll():
+            while not stop_event.is_set():
+                read()
+                stop_event.wait(self.config["power_poll_seconds"])
+
+        thread = threading.Thread(target=poll, name="power-polling", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_power_polling(self):
+        self._power_stop_event.set()
+
+    def auto_control_process(self, apply=None, on_cycle=None):
+        """
+        Automatic control loop based on external data, runs until stop_auto_control() is called.
+        The limits API is polled every poll_seconds and only the slaves picked by the AdaptiveScheduler
+        are sent to apply(percentages, ramp_seconds, on_results) (default: apply_percentages on this thread), which
+        calls on_results({key: SlaveResult}) once written so failed slaves are planned again; on_cycle(counter)
+        is called after every poll that wrote to a slave.
+        """
+        apply = apply or self.apply_percentages
+        stop_event = self._stop_event
+        scheduler = self.create_scheduler()
+        while self.auto_control and not stop_event.is_set():
+            started = time.perf_counter()
+            self.auto_control_step(scheduler, apply, on_cycle)
+            self.metrics.observe_cycle(time.perf_counter() - started)
+
+            stop_event.wait(self.config["poll_seconds"])  # ends at once on stop
+
+    def create_scheduler(self, clock=time.monotonic):
+        # AdaptiveScheduler of the auto control loop, set up from the config.
+        return AdaptiveScheduler(par_threshold=self.config["par_threshold"],
+                                 hysteresis=self.config["hysteresis_percent"],
+                                 min_dwell=self.config["min_dwell_seconds"],
+                                 resync_seconds=self.config["cycle_seconds"], clock=clock)
+
+    def auto_control_step(self, scheduler, apply, on_cycle=None):
+        # One poll of the auto control loop, returns the applied {key: percentage} (empty when nothing changed).
+        try:
+            self.api_snapshot.refresh(force=True)  # conditional request, cheap when nothing changed
+            evaluated = self.evaluate_zones()
+            if evaluated is None:
+                logging.error("No limits data available, skipping this cycle.")
+                return {}
+            percentages, zone_inputs, breach = evaluated
+            self.notify_breach(breach)
+            planned = scheduler.plan(percentages, zone_inputs, breach)
+            if planned:
+                logging.info(f"Auto control: applying {planned}")
+
+                def applied(results):
+                    scheduler.forget_failed(results)
+                    # Counts the executions that wrote to at least one slave, breaker-skipped slaves are not tried
+                    if any(not isinstance(result.error, CircuitOpenError) for result in results.values()):
+                        self.auto_control_counter += 1
+                        if on_cycle:
+                            on_cycle(self.auto_control_counter)
+
+                # Over the grid limit the brightness drops at once, otherwise it fades
+                apply(planned, ramp_seconds=0 if breach else self.config["ramp_seconds"], on_results=applied)
+            return planned
+        except (TypeError, ValueError, AttributeError, IndexError) as e:
+            # Missing or malformed cells in the limits table, try again next cycle
+            logging.error(f"Auto control cycle failed: {e}")
+            return {}
+
+    def start_auto_control(self, apply=None, on_cycle=None):
+        # Run auto_control_process in a daemon thread.
+        self.auto_control = True
+        self._stop_event = threading.Event()
+        thread = threading.Thread(target=self.auto_control_process, args=(apply, on_cycle),
+                                  name="auto-control", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_auto_control(self):
+        # Stop the auto control loop, an ongoing wait between polls ends immediately.
+        self.auto_control = False
+        self._stop_event.set()
+
+    def disable_slaves(self, keys=None):
+        # Switch the given slaves (default all) back to local control, stopping their fades first.
+        self.ramps.cancel(keys)
+        return self.fleet.write_all("enable", 0, keys)
+
+    def disable_all_slaves(self):
+        # Switch every slave back to local control, returns True when all succeeded.
+        results = self.disable_slaves()
+        return all(result.success for result in results.values())
+
+    def close(self):
+        self.stop_auto_control()
+        self.stop_power_polling()
+        self.ramps.stop()
+        self.fleet.close()
+        if self.power_store is not None:
+            self.power_store.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self._api_snapshot is not None:
+            self._api_snapshot.close()
+        if self._notifier is not None:
+            self._notifier.close()
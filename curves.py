@@ -0,0 +1,93 @@
+"""
+Dimming curves evaluated for many zones at once with NumPy. A curve maps the PAR value of a zone
+to a brightness percentage through the zone's limits: below the first limit the `below` clamp is
+used, above the last one the `above` clamp, and in between the curve goes from percentages[i - 1]
+to percentages[i] over the interval (limits[i - 1], limits[i]].
+"""
+import numpy as np
+
+DEFAULT_PERCENTAGES = (100, 80, 60, 40, 20)
+
+
+def _smoothstep(t):
+    return t * t * (3 - 2 * t)
+
+
+# Easing of the position t in [0, 1] inside one interval; "linear" is the original interpolation
+CURVE_SHAPES = {
+    "linear": None,
+    "smoothstep": _smoothstep,
+    "step": np.zeros_like,  # hold the percentage of the lower limit until the next one
+}
+
+
+class DimmingCurve:
+    def __init__(self, percentages=DEFAULT_PERCENTAGES, below=100, above=20, shape="linear"):
+        if shape not in CURVE_SHAPES:
+            raise ValueError(f"Unknown curve shape {shape!r}, expected one of {', '.join(CURVE_SHAPES)}")
+        self.percentages = np.asarray(percentages, dtype=float)
+        self.below = below
+        self.above = above
+        self.shape = shape
+
+    def evaluate(self, par_values, limits):
+        """
+        Percentages for arrays of PAR values, shape (zones,), and limits, shape (zones, len(percentages)).
+        Every zone is binned like searchsorted(limits[zone], par, side="left") in one pass.
+        """
+        par = np.asarray(par_values, dtype=float)
+        if not par.size:
+            return par
+        limits = np.asarray(limits, dtype=float)
+        if limits.shape != par.shape + self.percentages.shape:
+            raise ValueError(f"Expected limits of shape {par.shape + self.percentages.shape}, got {limits.shape}")
+        index = (par[..., None] > limits).sum(axis=-1)
+        inside = (index > 0) & (index < limits.shape[-1])
+
+        # Interval ends of every zone, zones outside the limits use interval 1 and are clamped below
+        upper = np.clip(index, 1, limits.shape[-1] - 1)
+        x0 = np.take_along_axis(limits, (upper - 1)[..., None], axis=-1)[..., 0]
+        x1 = np.take_along_axis(limits, upper[..., None], axis=-1)[..., 0]
+        y0 = self.percentages[upper - 1]
+        y1 = self.percentages[upper]
+        width = np.where(x1 > x0, x1 - x0, 1)
+        ease = CURVE_SHAPES[self.shape]
+        with np.errstate(invalid="ignore"):
+            if ease is None:
+                values = y0 + (par - x0) * (y1 - y0) / width
+            else:
+                values = y0 + ease(np.clip((par - x0) / width, 0, 1)) * (y1 - y0)
+        return np.where(inside, values, np.where(index == 0, self.below, self.above))
+
+    def compile(self, limits, max_par=None):
+        # Precompute the percentages of every zone for integer PAR 0..max_par (default: the highest limit).
+        return CurveTable(self, limits, max_par)
+
+
+class CurveTable:
+    """
+    Lookup table of a curve for a fixed set of zone limits: table[zone, par] for integer PAR in
+    0..max_par. PAR values outside the table or not integral are evaluated directly.
+    """
+
+    def __init__(self, curve, limits, max_par=None):
+        self.curve = curve
+        self.limits = np.asarray(limits, dtype=float)
+        zones = self.limits.shape[0]
+        self.max_par = int(max_par if max_par is not None else max(0, self.limits.max(initial=0)))
+        par = np.broadcast_to(np.arange(self.max_par + 1, dtype=float), (zones, self.max_par + 1))
+        limits_per_par = np.broadcast_to(self.limits[:, None, :], par.shape + self.limits.shape[-1:])
+        self.table = curve.evaluate(par, limits_per_par)
+
+    def matches(self, limits):
+        limits = np.asarray(limits, dtype=float)
+        return limits.shape == self.limits.shape and np.array_equal(limits, self.limits)
+
+    def evaluate(self, par_values):
+        par = np.asarray(par_values, dtype=float)
+        zones = np.arange(par.shape[0])
+        in_table = (par >= 0) & (par <= self.max_par) & (par == np.floor(par))
+        values = self.table[zones, np.where(in_table, par, 0).astype(int)]
+        if not in_table.all():
+            values[~in_table] = self.curve.evaluate(par[~in_table], self.limits[~in_table])
+        return values
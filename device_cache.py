@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+
+from register_map import REGISTERS
+
+ENABLE_REGISTER = REGISTERS["enable"].address
+
+
+class DeviceStateCache:
+    """
+    Write-through shadow of the last known holding register values of every slave.
+    Values are recorded after successful writes and reads. A value younger than `ttl` seconds
+    is trusted: writing the same value again is suppressed and the guard read before a write
+    is skipped. Entries of a slave are dropped on any error, and the whole cache on reconnect.
+    """
+
+    def __init__(self, ttl=900, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.suppressed_writes = 0
+        self._values = {}  # {slave_id: {address: (value, timestamp)}}
+        self._lock = threading.Lock()
+
+    def update(self, slave_id, address, value):
+        # Record a value confirmed by the device.
+        with self._lock:
+            self._values.setdefault(slave_id, {})[address] = (value, self.clock())
+
+    def get(self, slave_id, address, max_age=None):
+        # Return the cached value if it is younger than max_age (default ttl), otherwise None.
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._values.get(slave_id, {}).get(address)
+        if entry is None or self.clock() - entry[1] > max_age:
+            return None
+        return entry[0]
+
+    def last_known(self, slave_id, address):
+        # Return the cached value regardless of its age, or None.
+        with self._lock:
+            entry = self._values.get(slave_id, {}).get(address)
+        return None if entry is None else entry[0]
+
+    def is_fresh(self, slave_id):
+        # True when the slave answered within the ttl, so a guard read can be skipped.
+        now = self.clock()
+        with self._lock:
+            return any(now - timestamp <= self.ttl for _, timestamp in self._values.get(slave_id, {}).values())
+
+    def needs_write(self, slave_id, address, value):
+        # False (and counted as suppressed) when the device is known to hold this value already.
+        if self.get(slave_id, address) == value:
+            with self._lock:
+                self.suppressed_writes += 1
+            logging.debug(f"Slave {slave_id}: register {address} already {value}, write suppressed")
+            return False
+        return True
+
+    def take_suppressed(self):
+        # Return the number of suppressed writes since the last call and reset the counter.
+        with self._lock:
+            count, self.suppressed_writes = self.suppressed_writes, 0
+        return count
+
+    def invalidate(self, slave_id=None):
+        # Forget one slave (after an error) or everything (after a reconnect).
+        with self._lock:
+            if slave_id is None:
+                self._values.clear()
+            else:
+                self._values.pop(slave_id, None)
+
+    def is_enabled(self, slave_id):
+        # True when the slave was last seen in Modbus mode (register 25 = 1).
+        return self.last_known(slave_id, ENABLE_REGISTER) == 1
@@ -0,0 +1,163 @@
+"""
+Fleet of Modbus gateways, each one with its own slaves, device state cache and pooled
+AsyncModbusEngine. Slaves are addressed by key (gateway name, slave id). Operations are
+scheduled on every gateway at once and the results are merged, so a control cycle over many
+gateways takes about as long as the slowest gateway.
+"""
+import logging
+
+from device_cache import DeviceStateCache
+from modbus_engine import AsyncModbusEngine
+
+
+class Slave:
+    # One dimming module behind a gateway and the row of the limits API that drives it.
+    def __init__(self, gateway, slave_id, name, api_row):
+        self.gateway = gateway
+        self.slave_id = slave_id
+        self.name = name
+        self.api_row = api_row
+
+    @property
+    def key(self):
+        return self.gateway.name, self.slave_id
+
+    def __repr__(self):
+        return f"Slave({self.gateway.name!r}, {self.slave_id}, {self.name!r}, api_row={self.api_row})"
+
+
+class Gateway:
+    """
+    Modbus TCP gateway with a persistent connection pool. Connections are opened on first use
+    and re-opened lazily by the engine when they drop. Slaves of one gateway share at most
+    `concurrency` connections; with concurrency 1 they are handled strictly one after another.
+    """
+
+    def __init__(self, name, host, port=502, concurrency=4, timeout=3, cache_ttl=900, metrics=None, retries=1,
+                 deadline=10, breaker_threshold=3, probe_max_delay=300):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.slaves = []
+        self.cache = DeviceStateCache(ttl=cache_ttl)
+        self.engine = AsyncModbusEngine(host, port=port, concurrency=concurrency, timeout=timeout, cache=self.cache,
+                                        metrics=metrics, name=name, retries=retries, deadline=deadline,
+                                        breaker_threshold=breaker_threshold, probe_max_delay=probe_max_delay)
+
+    def slave_status(self, slave_id):
+        # "unreachable" (gateway down), "skipped" (breaker open), "modbus" or "local".
+        if not self.engine.gateway_breaker.allow():
+            return "unreachable"
+        if not self.engine.is_available(slave_id):
+            return "skipped"
+        return "modbus" if self.cache.is_enabled(slave_id) else "local"
+
+    def add_slave(self, slave_id, name, api_row):
+        slave = Slave(self, slave_id, name, api_row)
+        self.slaves.append(slave)
+        return slave
+
+    def __repr__(self):
+        return f"Gateway({self.name!r}, {self.host}:{self.port}, {len(self.slaves)} slaves)"
+
+
+class Fleet:
+    def __init__(self, gateways):
+        self.gateways = {gateway.name: gateway for gateway in gateways}
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """
+        Build the fleet from config["gateways"]: a list of {name, host, port, concurrency, timeout,
+        slaves: [{id, name, api_row}]} in display order. Missing per-gateway values fall back to
+        modbus_port, modbus_concurrency, modbus_timeout and cache_ttl of the config; retries, deadlines
+        and circuit breakers are set by modbus_retries, slave_deadline, breaker_threshold and probe_max_delay.
+        All engines report to the optional Metrics registry.
+        """
+        gateways = []
+        for gateway_config in config["gateways"]:
+            name = gateway_config.get("name") or gateway_config["host"]
+            if any(gateway.name == name for gateway in gateways):
+                raise ValueError(f"Duplicate gateway name {name!r} in config")
+            gateway = Gateway(name, gateway_config["host"],
+                              port=gateway_config.get("port", config["modbus_port"]),
+                              concurrency=gateway_config.get("concurrency", config["modbus_concurrency"]),
+                              timeout=gateway_config.get("timeout", config["modbus_timeout"]),
+                              cache_ttl=config["cache_ttl"], metrics=metrics,
+                              retries=config["modbus_retries"], deadline=config["slave_deadline"],
+                              breaker_threshold=config["breaker_threshold"],
+                              probe_max_delay=config["probe_max_delay"])
+            for slave_config in gateway_config["slaves"]:
+                slave_id = int(slave_config["id"])
+                if any(slave.slave_id == slave_id for slave in gateway.slaves):
+                    raise ValueError(f"Duplicate slave id {slave_id} on gateway {name!r}")
+                gateway.add_slave(slave_id, slave_config.get("name", f"Module {slave_id}"),
+                                  slave_config.get("api_row"))
+            gateways.append(gateway)
+        return cls(gateways)
+
+    @property
+    def slaves(self):
+        # All slaves of all gateways in display order.
+        return [slave for gateway in self.gateways.values() for slave in gateway.slaves]
+
+    def slave(self, key):
+        gateway_name, slave_id = key
+        return next(slave for slave in self.gateways[gateway_name].slaves if slave.slave_id == slave_id)
+
+    def _by_gateway(self, keyed):
+        # Split {(gateway name, slave id): value} into {gateway: {slave id: value}}.
+        split = {}
+        for (gateway_name, slave_id), value in keyed.items():
+            split.setdefault(self.gateways[gateway_name], {})[slave_id] = value
+        return split
+
+    @staticmethod
+    def _gather(futures):
+        # Wait for {gateway: future of {slave id: SlaveResult}}, returns {(gateway name, slave id): SlaveResult}.
+        results = {}
+        for gateway, future in futures.items():
+            for slave_id, result in future.result().items():
+                results[(gateway.name, slave_id)] = result
+        return results
+
+    def apply_flux_all(self, slave_flux):
+        # Apply {key: flux}; gateways run in parallel, each with its own connection pool.
+        return self._gather({gateway: gateway.engine.submit(gateway.engine.apply_flux_all_async(flux))
+                             for gateway, flux in self._by_gateway(slave_flux).items()})
+
+    def read_all(self, names, keys=None):
+        # Read the named registers of the given slaves (default all) on every gateway in parallel.
+        keys = keys if keys is not None else [slave.key for slave in self.slaves]
+        return self._gather({gateway: gateway.engine.submit(gateway.engine.read_all_async(list(ids), names))
+                             for gateway, ids in self._by_gateway(dict.fromkeys(keys)).items()})
+
+    def write_all(self, name, value, keys=None):
+        # Write one named register of the given slaves (default all) on every gateway in parallel.
+        keys = keys if keys is not None else [slave.key for slave in self.slaves]
+        return self._gather({gateway: gateway.engine.submit(gateway.engine.write_all_async(list(ids), name, value))
+                             for gateway, ids in self._by_gateway(dict.fromkeys(keys)).items()})
+
+    def write_each(self, name, values):
+        # Write {key: value} to one named register, a value per slave, on every gateway in parallel.
+        return self._gather({gateway: gateway.engine.submit(gateway.engine.write_each_async(name, slave_values))
+                             for gateway, slave_values in self._by_gateway(values).items()})
+
+    def check_connections(self):
+        # Try to connect to every gateway, returns the names of the unreachable ones.
+        futures = {gateway: gateway.engine.submit(gateway.engine.check_connection())
+                   for gateway in self.gateways.values()}
+        return [gateway.name for gateway, future in futures.items() if not future.result()]
+
+    def slave_status(self, key):
+        gateway_name, slave_id = key
+        return self.gateways[gateway_name].slave_status(slave_id)
+
+    def take_suppressed(self):
+        # Redundant writes suppressed on all gateways since the last call.
+        return sum(gateway.cache.take_suppressed() for gateway in self.gateways.values())
+
+    def close(self):
+        for gateway in self.gateways.values():
+            gateway.engine.close()
+        logging.info("All gateway connections closed.")
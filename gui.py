@@ -0,0 +1,383 @@
+import tkinter as tk
+from tkinter import messagebox
+from functools import partial
+import logging
+import time
+
+from control_core import ControlCore
+from modbus_engine import SlaveResult
+from modbus_worker import ModbusWorker
+
+
+# noinspection PyTypeChecker
+class ModbusApp:
+    def __init__(self, core=None):
+        # Initialize main window settings and Modbus connection parameters
+        self.top = tk.Tk()
+        self.top.title("Modbus Automate")
+
+        # Gateway fleet, limits API and the auto control loop live in the core
+        self.core = core or ControlCore()
+        self.core.on_api_error = lambda e: self.top.after(0, messagebox.showerror, "Network Error", str(e))
+        self.mflux = self.core.mflux
+        self.slave_address = None  # selected slave key (gateway name, slave id)
+        self.slaves = self.core.fleet.slaves  # all slaves of all gateways in display order
+        self.slave_keys = [slave.key for slave in self.slaves]
+        rows = (len(self.slaves) + 1) // 2
+        self.top.geometry(f"450x{495 + max(0, rows - 4) * 50}")
+        self.power_update_timer = None
+        self.counter_label = None
+        self.stats_window = None
+        self.auto_dimming_button = None
+
+        # All Modbus I/O runs on this thread, results come back to the widgets through self.top.after
+        self.worker = ModbusWorker(dispatch=lambda callback, result: self.top.after(0, callback, result))
+        self.worker.start()
+        self.worker.submit(("connect",), self.core.fleet.check_connections, callback=self.show_connection_result)
+        self.core.start_power_polling(read=self.update_power_display)
+
+        # UI elements references
+        self.button_references = []
+        self.dot_references = []
+        self.percentage_labels = []
+        self.power_labels = []
+
+        # Set up the GUI components
+        self.setup_gui()
+
+    def __del__(self):
+        # Close Modbus connection when the application is closing.
+        self.worker.stop(timeout=5)
+        self.core.close()
+
+    @staticmethod
+    def show_connection_result(unreachable):
+        # Tell the user when the worker could not connect to some gateways.
+        if unreachable:
+            if isinstance(unreachable, Exception):
+                unreachable = [str(unreachable)]
+            messagebox.showerror("Connection error", f"The connection to {', '.join(unreachable)} cannot be "
+                                                     "established. Verify that you are connected to the local "
+                                                     "network, or your VPN is enabled.")
+
+    def close_modbus_client(self):
+        # Close modbus connections of all gateways, flush the power history and stop the metrics server
+        self.core.close()
+
+    def set_slave_address(self, address, button=None):
+        # Set the current slave (gateway name, slave id) and update UI.
+        self.slave_address = address
+        if button:
+            self.update_button_colors(button)
+        self.update_dot_colors()
+        logging.info(f"Module address set to {self.slave_address}")
+
+    def update_button_colors(self, active_button):
+        # Update the color of slave buttons to indicate the current selection.
+        for btn in self.button_references:
+            btn.config(bg='SystemButtonFace')
+        if active_button:
+            active_button.config(bg='light gray')
+
+    @staticmethod
+    def handle_modbus_error(exception, operation="operation"):
+        """
+        Handles exceptions from Modbus operations, logs the error, and shows a user-friendly message.
+        Parameters:
+        exception (Exception): The caught exception.
+        operation (str): Description of the operation during which the error occurred.
+        """
+        logging.error(f"Modbus {operation} failed: {exception}")
+        messagebox.showerror("Modbus error", f"An error occurred during {operation}.")
+
+    def apply_percentage(self, percentage):
+        # Validate the percentage and queue it for the currently selected slave
+        if self.slave_address is None:
+            messagebox.showinfo("Slave not selected",
+                                "Please select a block before applying the percentage value.")
+            return False
+        try:
+            percentage_val = int(percentage)
+            if percentage_val < 0 or percentage_val > 100:
+                messagebox.showerror("Incorrect input data", "The value must be between 0 and 100.")
+                return False
+        except ValueError:
+            messagebox.showerror("Incorrect input data", "The value must be between 0 and 100.")
+            return False
+
+        if self.slave_address not in self.slave_keys:
+            messagebox.showerror("Error", "Incorrect slave address.")
+            return False
+        self.submit_percentages({self.slave_address: percentage_val})
+        return True
+
+    def submit_percentages(self, percentages, ramp_seconds=None, on_results=None, dialog=True):
+        """
+        Queue brightness for the given slaves on the Modbus worker, {(gateway name, slave id): percentage}.
+        Commands are coalesced by slave set: a new command supersedes every waiting one whose slaves
+        it covers. The brightness fades over ramp_seconds (default: the configured ramp_seconds).
+        on_results({key: SlaveResult}) is called on the Tk thread once the command ran. Failed slaves are
+        reported in a dialog, or only logged without `dialog` (auto control).
+        """
+        if ramp_seconds is None:
+            ramp_seconds = self.core.config["ramp_seconds"]
+        keys = frozenset(percentages)
+        self.worker.submit(("flux", keys), self.core.apply_percentages, percentages, ramp_seconds,
+                           callback=partial(self.show_engine_results, percentages=percentages, on_results=on_results,
+                                            dialog=dialog),
+                           replaces=lambda pending: pending[0] == "flux" and pending[1] <= keys)
+
+    def apply_percentage_to_all(self, percentage):
+        # Apply a given percentage to all slaves of all gateways, running them concurrently
+        logging.info(f"Set up {percentage}% for all slaves")
+        try:
+            percentage_val = int(percentage)
+        except ValueError:
+            messagebox.showerror("Incorrect input data", "The value must be between 0 and 100.")
+            return False
+        if percentage_val < 0 or percentage_val > 100:
+            messagebox.showerror("Incorrect input data", "The value must be between 0 and 100.")
+            return False
+        self.submit_percentages({key: percentage_val for key in self.slave_keys})
+        return True
+
+    def show_engine_results(self, results, percentages, on_results=None, dialog=True):
+        """
+        Update status dots, percentage and power labels from engine results and report failed slaves.
+        Runs on the Tk thread. Returns the names of the slaves that failed.
+        """
+        if isinstance(results, Exception):
+            results = {key: SlaveResult(key[1], False, error=results) for key in percentages}
+        if on_results is not None:
+            on_results(results)
+        failed = []
+        for key, result in results.items():
+            index = self.slave_keys.index(key)
+            if result.success:
+                self.percentage_labels[index].config(text=f"{percentages[key]}%")
+                self.power_labels[index].config(text=f"{result.power} W")
+                logging.info(f"Set to {percentages[key]}% for slave {key}")
+            else:
+                failed.append(self.slaves[index].name)
+        self.update_dot_colors()
+        if failed and dialog:
+            messagebox.showerror("Connection error", f"Error at slaves: {', '.join(failed)}.")
+        elif failed:
+            logging.error(f"Error at slaves: {', '.join(failed)}.")
+        return failed
+
+    def close_selected_connection(self):
+        # Queue a command to disable modbus mode on the current slave
+        if self.slave_address is None:
+            return
+        key = self.slave_address
+        logging.info(f"Closing connection with {key} slave")
+        # Disabling the slave makes any brightness still waiting for it pointless
+        self.worker.submit(("enable", key), self.core.disable_slaves, [key],
+                           replaces=lambda pending: pending == ("flux", frozenset([key])),
+                           callback=self.show_close_result)
+
+    def show_close_result(self, results):
+        self.update_dot_colors()
+        if isinstance(results, Exception) or not all(result.success for result in results.values()):
+            messagebox.showerror("Modbus Error", "The module cannot be switched back to local control.")
+
+    def update_dot_colors(self):
+        # Update dot colors in display order: green Modbus mode, red local control,
+        # orange skipped by its circuit breaker, grey gateway unreachable
+        colors = {"modbus": "green", "local": "red", "skipped": "orange", "unreachable": "grey"}
+        for key, dot in zip(self.slave_keys, self.dot_references):
+            dot.config(fg=colors[self.core.fleet.slave_status(key)])
+        logging.info("Dott color update")
+
+    def update_power_display(self):
+        # Queue a power poll of all slaves, repeated requests collapse into one.
+        self.worker.submit(("power",), self.core.read_power, callback=self.show_power_results)
+
+    def show_power_results(self, results):
+        # Show power readings in display order, runs on the Tk thread.
+        if isinstance(results, Exception):
+            messagebox.showerror("Error", f"Error updating power display: {results}")
+            return
+        for i, key in enumerate(self.slave_keys):
+            result = results[key]
+            if result.success:
+                self.power_labels[i].config(text=f"{result.power} W")
+            else:
+                self.power_labels[i].config(text="Read error")
+        self.update_dot_colors()  # breakers may have opened or closed since the last command
+
+    def on_close(self):
+        # Attempt to close all connections gracefully on application close
+        logging.info("Program shutdown...")
+        self.core.stop_auto_control()
+        self.core.stop_power_polling()
+        # Pending brightness changes are dropped, the slaves go back to local control
+        self.worker.submit(("shutdown",), self.core.disable_all_slaves, replaces=lambda pending: True,
+                           callback=self.finish_close)
+
+    def finish_close(self, success):
+        if success is not True:
+            messagebox.showerror("Connection error", "The program cannot be closed successfully.")
+        else:
+            logging.info("All connections closed successfully.")
+        if self.power_update_timer:
+            self.power_update_timer.cancel()
+        self.worker.stop(timeout=5)
+        self.close_modbus_client()
+        self.top.destroy()
+
+    def setup_gui(self):
+        # Set up the GUI layout
+        tk.Label(self.top, text="Select slave", font="Courier 10").pack(pady=10)
+        self.create_slave_buttons()
+        self.setup_control_buttons()
+        self.top.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.counter_label = tk.Label(self.top, text="Number of automatic executions: 0")
+        self.counter_label.pack()
+        panel_frame = tk.Frame(self.top)
+        panel_frame.pack(pady=5)
+        tk.Button(panel_frame, text="Statistics", command=self.open_stats_panel).pack(side=tk.LEFT, padx=5)
+        if self.core.power_store is not None:
+            tk.Button(panel_frame, text="Power history", command=self.open_power_history).pack(side=tk.LEFT, padx=5)
+
+    def open_power_history(self):
+        # Plot the power of the selected slave over the last 24 hours from the recorded history
+        if self.slave_address is None:
+            messagebox.showinfo("Slave not selected", "Select a slave to show its power history.")
+            return
+        width, height, margin = 600, 250, 40
+        end = time.time()
+        times, watts = self.core.power_store.series(self.slave_address, end - 86400, end)
+        window = tk.Toplevel(self.top)
+        window.title(f"Power history - {self.core.fleet.slave(self.slave_address).name}")
+        canvas = tk.Canvas(window, width=width, height=height, bg="white")
+        canvas.pack(padx=10, pady=10)
+        canvas.create_rectangle(margin, 10, width - 10, height - margin)
+        if not len(times):
+            canvas.create_text(width // 2, height // 2, text="No power history yet")
+            return
+        top_watts = max(1.0, float(watts.max()))
+        x = margin + (times - (end - 86400)) / 86400 * (width - 10 - margin)
+        y = height - margin - watts / top_watts * (height - 10 - margin)
+        if len(x) > 1:
+            canvas.create_line(*[coordinate for point in zip(x.tolist(), y.tolist()) for coordinate in point],
+                               fill="blue")
+        canvas.create_text(margin - 5, 10, text=f"{top_watts:.0f} W", anchor="ne")
+        canvas.create_text(margin - 5, height - margin, text="0 W", anchor="e")
+        canvas.create_text(margin, height - margin + 15, text="-24 h", anchor="w")
+        canvas.create_text(width - 10, height - margin + 15, text="now", anchor="e")
+
+    def open_stats_panel(self):
+        # Window with Modbus latency and error counts per slave, refreshed every 2 s while open
+        if self.stats_window is not None and self.stats_window.winfo_exists():
+            self.stats_window.lift()
+            return
+        self.stats_window = tk.Toplevel(self.top)
+        self.stats_window.title("Modbus statistics")
+        label = tk.Label(self.stats_window, font="Courier 10", justify=tk.LEFT, anchor="w")
+        label.pack(padx=10, pady=10)
+        self.refresh_stats_panel(label)
+
+    def refresh_stats_panel(self, label):
+        if self.stats_window is None or not self.stats_window.winfo_exists():
+            return
+        names = {slave.key: slave.name for slave in self.slaves}
+        lines = [f"{'slave':<22}{'requests':>9}{'errors':>8}{'timeouts':>9}{'p50 ms':>8}{'p95 ms':>8}"]
+        for gateway, slave_id, requests, errors, timeouts, p50, p95 in self.core.metrics.slave_summary():
+            name = names.get((gateway, slave_id), f"{gateway}/{slave_id}")
+            lines.append(f"{name:<22}{requests:>9}{errors:>8}{timeouts:>9}{p50 * 1000:>8.0f}{p95 * 1000:>8.0f}")
+        if len(lines) == 1:
+            lines.append("No Modbus requests yet")
+        label.config(text="\n".join(lines))
+        self.stats_window.after(2000, self.refresh_stats_panel, label)
+
+    def create_slave_buttons(self):
+        # Create buttons at the top od the program
+        master_frame = tk.Frame(self.top, bg="#e0e9d8")
+        master_frame.pack(pady=10)
+        left_frame = tk.Frame(master_frame, bg="#e0e9d8")
+        left_frame.pack(side=tk.LEFT, padx=5)
+        right_frame = tk.Frame(master_frame, bg="#e0e9d8")
+        right_frame.pack(side=tk.LEFT, padx=5)
+        self.power_labels = []
+
+        halfway_point = (len(self.slaves) + 1) // 2
+
+        for i, slave in enumerate(self.slaves):
+            name = slave.name
+            is_left_side = i < halfway_point
+            target_frame = left_frame if is_left_side else right_frame
+            row_frame = tk.Frame(target_frame, bg="#e0e9d8")
+            row_frame.pack(fill=tk.X, padx=5, pady=2)
+
+            # Set up the grid with 2 columns
+            row_frame.columnconfigure(0, weight=1)
+            row_frame.columnconfigure(1, weight=1)
+
+            button = tk.Button(row_frame, text=name, width=20)
+            dot = tk.Label(row_frame, text="●", fg='red', font=('Helvetica', 14), bg="#e0e9d8")
+            power = tk.Label(row_frame, text="--- W", fg='red', bg="#e0e9d8")
+            percentage = tk.Label(row_frame, text="0%", fg='blue', bg="#e0e9d8")
+            button.configure(command=lambda addr=slave.key, btn=button: self.set_slave_address(addr, btn))
+
+            if is_left_side:
+                # Place the dot on the left, button on the right
+                dot.grid(row=0, column=2, sticky="e")
+                percentage.grid(row=0, column=1, sticky="e")
+                button.grid(row=0, column=0, sticky="w")
+                power.grid(row=1, column=0, columnspan=2, sticky="s")
+
+            else:
+                # Place the button on the left, dot on the right
+
+                dot.grid(row=0, column=0, sticky="e")
+                percentage.grid(row=0, column=1, sticky="e")
+                button.grid(row=0, column=2, sticky="w")
+                power.grid(row=1, column=1, columnspan=2, sticky="s")
+
+            self.button_references.append(button)
+            self.dot_references.append(dot)
+            self.power_labels.append(power)
+            self.percentage_labels.append(percentage)
+
+    def setup_control_buttons(self):
+        # Setup controls for applying percentage
+        close_selected_connection = tk.Button(self.top, text="  Close \n  selected  \n  connection  ", fg="black",
+                                              bg="#ff432e", width=12, height=3,
+                                              command=self.close_selected_connection)
+        close_selected_connection.pack(side=tk.RIGHT, padx=(0, 10))
+        self.auto_dimming_button = tk.Button(self.top, text="Auto \ncontrol", fg="black", bg="lightblue",
+                                             command=self.toggle_auto_control, width=12, height=3)
+        self.auto_dimming_button.pack(side=tk.LEFT, pady=10, padx=(10, 0))
+        tk.Label(self.top, text="Set the brightness (%):", font="Courier 10").pack(pady=10)
+        percentage_entry = tk.Entry(self.top, width=20)
+        percentage_entry.pack(pady=10)
+        apply_button = tk.Button(self.top, text="Apply",
+                                 command=lambda: self.apply_percentage(percentage_entry.get()))
+        apply_button.pack(pady=5)
+        apply_all_button = tk.Button(self.top, text="Apply for all",
+                                     command=lambda: self.apply_percentage_to_all(percentage_entry.get()))
+        apply_all_button.pack(pady=5)
+
+    def toggle_auto_control(self):
+        # Toggle the state of automatic control, initiating background processing if enabled.
+        if not self.core.auto_control:
+            logging.info("Automatic control has been enabled.")
+            self.core.auto_control_counter += 1  # Increment loop counter
+            self.auto_dimming_button.config(bg='lightgreen', text="Auto \ncontrol \n(in use)", width=12,
+                                            height=3)
+            self.core.start_auto_control(apply=partial(self.submit_percentages, dialog=False),
+                                         on_cycle=lambda counter: self.top.after(0, self.show_counter, counter))
+            self.show_counter(self.core.auto_control_counter)
+        else:
+            logging.info("Automatic control has been disabled.")
+            self.core.stop_auto_control()
+            self.auto_dimming_button.config(bg='lightblue', text=f"Auto \ncontrol", width=12, height=3)
+
+    def show_counter(self, counter):
+        self.counter_label.config(text=f"Number of automatic executions: {counter}")
+
+    def run(self):
+        # Start the GUI event loop
+        self.top.mainloop()
@@ -0,0 +1,181 @@
+"""
+Latency histograms and counters for every Modbus and HTTP call and for the auto control cycle,
+exported in the Prometheus text format by a small local HTTP server.
+"""
+import bisect
+import http.server
+import logging
+import threading
+
+# Upper bounds in seconds, Modbus round trips over a VPN are in the 5 ms .. 2 s range
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Modbus/TCP ADU sizes: 7 byte MBAP header + PDU
+READ_REQUEST_BYTES = 12
+WRITE_REQUEST_BYTES = 12
+WRITE_RESPONSE_BYTES = 12
+
+
+def read_response_bytes(count):
+    return 9 + 2 * count
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the given quantile, None without samples.
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metrics:
+    """
+    Thread safe registry of labelled counters and histograms.
+    The observe_* helpers are what the engine, the API snapshot and the control loop call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # {name: (kind, help, label names, {label values: Histogram or float})}
+
+    def _family(self, name, kind, help_text, label_names):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help_text, label_names, {})
+        return family[3]
+
+    def inc(self, name, help_text, labels=None, value=1):
+        labels = labels or {}
+        with self._lock:
+            series = self._family(name, "counter", help_text, tuple(labels))
+            key = tuple(labels.values())
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, help_text, value, labels=None):
+        labels = labels or {}
+        with self._lock:
+            series = self._family(name, "histogram", help_text, tuple(labels))
+            key = tuple(labels.values())
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def observe_modbus(self, gateway, slave_id, op, address, seconds, request_bytes, response_bytes, error=None,
+                       timeout=False):
+        labels = {"gateway": gateway, "slave": slave_id, "op": op, "register": address}
+        self.observe("modbus_request_duration_seconds", "Modbus request round trip time", seconds, labels)
+        if timeout:
+            self.inc("modbus_request_timeouts_total", "Modbus requests without an answer", labels)
+        elif error is not None:
+            self.inc("modbus_request_errors_total", "Failed Modbus requests", labels)
+        self.inc("modbus_bytes_sent_total", "Modbus/TCP bytes sent", {"gateway": gateway}, request_bytes)
+        self.inc("modbus_bytes_received_total", "Modbus/TCP bytes received", {"gateway": gateway}, response_bytes)
+
+    def observe_http(self, endpoint, seconds, response_bytes=0, error=None):
+        labels = {"endpoint": endpoint}
+        self.observe("http_request_duration_seconds", "HTTP request duration", seconds, labels)
+        if error is not None:
+            self.inc("http_request_errors_total", "Failed HTTP requests", labels)
+        self.inc("http_bytes_received_total", "HTTP response body bytes", labels, response_bytes)
+
+    def observe_cycle(self, seconds):
+        self.observe("auto_control_cycle_duration_seconds", "Duration of one auto control cycle", seconds)
+
+    def slave_summary(self):
+        """
+        Per slave totals over all registers: [(gateway, slave, requests, errors, timeouts, p50, p95)],
+        percentiles are bucket upper bounds in seconds.
+        """
+        with self._lock:
+            durations = self._families.get("modbus_request_duration_seconds", (None, None, None, {}))[3]
+            errors = self._families.get("modbus_request_errors_total", (None, None, None, {}))[3]
+            timeouts = self._families.get("modbus_request_timeouts_total", (None, None, None, {}))[3]
+            merged = {}
+            for (gateway, slave_id, op, address), histogram in durations.items():
+                total = merged.setdefault((gateway, slave_id), [Histogram(), 0, 0])
+                total[0].counts = [a + b for a, b in zip(total[0].counts, histogram.counts)]
+                total[0].count += histogram.count
+                total[0].sum += histogram.sum
+            for (gateway, slave_id, op, address), value in errors.items():
+                merged.setdefault((gateway, slave_id), [Histogram(), 0, 0])[1] += value
+            for (gateway, slave_id, op, address), value in timeouts.items():
+                merged.setdefault((gateway, slave_id), [Histogram(), 0, 0])[2] += value
+        return [(gateway, slave_id, histogram.count, errors, timeouts, histogram.quantile(0.5),
+                 histogram.quantile(0.95))
+                for (gateway, slave_id), (histogram, errors, timeouts) in sorted(merged.items(), key=str)]
+
+    def render(self):
+        # Prometheus text exposition format.
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, label_names, series) in sorted(self._families.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for values, sample in series.items():
+                    if kind == "counter":
+                        lines.append(f"{name}{_format_labels(label_names, values)} {sample}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(sample.buckets + (float("inf"),), sample.counts):
+                        cumulative += count
+                        le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                        lines.append(f"{name}_bucket{_format_labels(label_names, values, le)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(label_names, values)} {sample.sum}")
+                    lines.append(f"{name}_count{_format_labels(label_names, values)} {sample.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    # Serves metrics.render() on http://host:port/metrics from a daemon thread.
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Metrics server: {format % args}")
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self._httpd.server_address[1]}/metrics"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logging.info(f"Metrics available on {self.url}")
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,355 @@
+import asyncio
+import logging
+import threading
+import time
+
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.transaction import ModbusSocketFramer
+import pymodbus.exceptions
+
+from circuit_breaker import CircuitBreaker
+from metrics import READ_REQUEST_BYTES, WRITE_REQUEST_BYTES, WRITE_RESPONSE_BYTES, read_response_bytes
+from register_map import REGISTERS, read_values_async
+
+ENABLE_REGISTER = REGISTERS["enable"].address
+FLUX_REGISTER = REGISTERS["flux"].address
+GUARD_REGISTER = REGISTERS["guard"].address
+POLL_REGISTERS = ("percentage", "power")  # read back after every flux write, one block read
+
+
+class CircuitOpenError(pymodbus.exceptions.ModbusException):
+    # The slave was skipped because its circuit breaker, or the one of its gateway, is open.
+    pass
+
+
+class SlaveResult:
+    # Outcome of one enable -> flux -> power sequence on a single slave.
+    def __init__(self, slave_id, success, flux=None, values=None, error=None):
+        self.slave_id = slave_id
+        self.success = success
+        self.flux = flux
+        self.values = values or {}
+        self.error = error
+
+    @property
+    def power(self):
+        return self.values.get("power")
+
+    def __repr__(self):
+        return (f"SlaveResult(slave_id={self.slave_id}, success={self.success}, flux={self.flux}, "
+                f"power={self.power}, error={self.error!r})")
+
+
+class AsyncModbusEngine:
+    """
+    Runs Modbus transactions for many slaves of one gateway concurrently.
+    The engine keeps a small pool of AsyncModbusTcpClient connections to the gateway, each one
+    with its own transaction id sequence, so up to `concurrency` slave sequences are in flight
+    at the same time. The asyncio loop lives in a daemon thread; blocking callers (Tk callbacks,
+    the auto control thread) submit() the *_async coroutines and wait for the future, as Fleet does.
+    With a DeviceStateCache writes of values the slave already holds are suppressed and the guard
+    read is skipped for slaves that answered recently.
+    With a Metrics registry every request is timed and counted under the gateway `name`.
+    Every request has a deadline of `timeout` seconds per attempt and every slave sequence one of
+    `deadline` seconds. A slave that does not answer `breaker_threshold` times in a row is skipped
+    and probed in the background instead; a gateway that cannot be connected is retried with backoff.
+    """
+
+    def __init__(self, host, port=502, concurrency=4, timeout=3, cache=None, metrics=None, name=None, retries=1,
+                 deadline=10, breaker_threshold=3, probe_delay=5, probe_max_delay=300):
+        self.host = host
+        self.port = port
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = deadline
+        self.cache = cache
+        self.metrics = metrics
+        self.name = name or host
+        self.breaker_threshold = breaker_threshold
+        self.probe_delay = probe_delay  # first probe of an open slave breaker, doubled up to probe_max_delay
+        self.probe_max_delay = probe_max_delay
+        self.breakers = {}  # {slave_id: CircuitBreaker}
+        self.gateway_breaker = CircuitBreaker(f"Gateway {self.name}", failure_threshold=1, base_delay=1,
+                                              max_delay=60)
+        self._probe_task = None
+        self._loop = None
+        self._thread = None
+        self._pool = None
+        self._clients = []
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        # Start the event loop thread on first use.
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="modbus-engine", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def submit(self, coro):
+        # Schedule a coroutine on the engine loop, returns a concurrent.futures.Future.
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    async def check_connection(self):
+        # True when a pooled connection to the gateway can be established.
+        try:
+            client = await self._acquire()
+        except pymodbus.exceptions.ModbusException as exc:
+            logging.error(str(exc))
+            return False
+        self._release(client)
+        return True
+
+    async def _acquire(self):
+        # Take a connected client from the pool, creating the pool on first use.
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+            for _ in range(self.concurrency):
+                # reconnect_delay=0: reconnects are done here, with the gateway breaker backoff
+                client = AsyncModbusTcpClient(self.host, port=self.port, framer=ModbusSocketFramer,
+                                              timeout=self.timeout, retries=self.retries, reconnect_delay=0)
+                self._clients.append(client)
+                self._pool.put_nowait(client)
+        client = await self._pool.get()
+        if not client.connected:
+            breaker = self.gateway_breaker
+            if not breaker.allow() and not breaker.probe_due():
+                self._pool.put_nowait(client)
+                retry_in = breaker.next_probe_at - breaker.clock()
+                raise CircuitOpenError(f"{self.host}:{self.port} unreachable, next attempt in {retry_in:.0f} s")
+            if not await client.connect():
+                self._pool.put_nowait(client)
+                # Opens at once; concurrent attempts that failed with it do not add to the backoff
+                if breaker.allow() or breaker.probe_due():
+                    breaker.record_failure()
+                self._start_probes()
+                raise pymodbus.exceptions.ConnectionException(f"Cannot connect to {self.host}:{self.port}")
+            if breaker.is_open and self.cache is not None:
+                # pymodbus drops the connection after every unanswered request, only an outage clears the cache
+                logging.info(f"Reconnected to {self.host}:{self.port}, device state cache cleared")
+                self.cache.invalidate()
+            breaker.record_success()
+        return client
+
+    def _release(self, client):
+        self._pool.put_nowait(client)
+
+    def _observe(self, op, address, slave_id, started, request_bytes, response_bytes, error=None):
+        if self.metrics is None:
+            return
+        # pymodbus reports a missing answer as ModbusIOException, asyncio as TimeoutError
+        timeout = isinstance(error, (asyncio.TimeoutError, pymodbus.exceptions.ModbusIOException))
+        self.metrics.observe_modbus(self.name, slave_id, op, address, time.perf_counter() - started,
+                                    request_bytes, response_bytes, error=error, timeout=timeout)
+
+    async def _read(self, client, address, count, slave_id):
+        started = time.perf_counter()
+        try:
+            rr = await client.read_holding_registers(address, count, slave=slave_id)
+            if rr.isError():
+                raise pymodbus.exceptions.ModbusException(str(rr))
+        except (pymodbus.exceptions.ModbusException, asyncio.TimeoutError) as exc:
+            self._observe("read", address, slave_id, started, READ_REQUEST_BYTES, 0, exc)
+            raise
+        self._observe("read", address, slave_id, started, READ_REQUEST_BYTES, read_response_bytes(count))
+        return rr.registers
+
+    async def _write(self, client, address, value, slave_id):
+        # Write one register unless the cache knows the slave already holds the value.
+        if self.cache is not None and not self.cache.needs_write(slave_id, address, value):
+            return
+        started = time.perf_counter()
+        try:
+            wr = await client.write_register(address, value, slave=slave_id)
+            if wr.isError():
+                raise pymodbus.exceptions.ModbusException(str(wr))
+        except (pymodbus.exceptions.ModbusException, asyncio.TimeoutError) as exc:
+            self._observe("write", address, slave_id, started, WRITE_REQUEST_BYTES, 0, exc)
+            raise
+        self._observe("write", address, slave_id, started, WRITE_REQUEST_BYTES, WRITE_RESPONSE_BYTES)
+        if self.cache is not None:
+            self.cache.update(slave_id, address, value)
+
+    async def _guard(self, client, slave_id):
+        # Check the slave answers before writing, unless it answered within the cache ttl.
+        if self.cache is not None and self.cache.is_fresh(slave_id):
+            return
+        registers = await self._read(client, GUARD_REGISTER, 1, slave_id)
+        if self.cache is not None:
+            self.cache.update(slave_id, GUARD_REGISTER, registers[0])
+
+    def _forget(self, slave_id):
+        if self.cache is not None:
+            self.cache.invalidate(slave_id)
+
+    def _breaker(self, slave_id):
+        breaker = self.breakers.get(slave_id)
+        if breaker is None:
+            breaker = self.breakers[slave_id] = CircuitBreaker(f"Slave {self.name}/{slave_id}",
+                                                               failure_threshold=self.breaker_threshold,
+                                                               base_delay=self.probe_delay,
+                                                               max_delay=self.probe_max_delay)
+        return breaker
+
+    def is_available(self, slave_id):
+        # False while the gateway is unreachable or the slave's breaker is open. Read-only: called from
+        # other threads, while the breakers are only created on the engine loop (no breaker = closed).
+        breaker = self.breakers.get(slave_id)
+        return self.gateway_breaker.allow() and (breaker is None or breaker.allow())
+
+    async def _guarded(self, slave_id, operation, body, **result_args):
+        """
+        Run body(client) for one slave with a pooled client, within the slave's circuit breaker and
+        the sequence deadline. Returns body's SlaveResult, or a failed one with the error.
+        """
+        breaker = self._breaker(slave_id)
+        if not breaker.allow():
+            return SlaveResult(slave_id, False, error=CircuitOpenError(f"{breaker.name} skipped, circuit open"),
+                               **result_args)
+        try:
+            client = await self._acquire()
+        except pymodbus.exceptions.ModbusException as exc:
+            logging.error(f"Slave {slave_id}: {exc}")
+            return SlaveResult(slave_id, False, error=exc, **result_args)
+        try:
+            result = await asyncio.wait_for(body(client), self.deadline)
+        except (pymodbus.exceptions.ModbusException, asyncio.TimeoutError) as exc:
+            logging.error(f"Slave {slave_id}: {operation} failed: {exc!r}")
+            self._forget(slave_id)
+            if isinstance(exc, asyncio.TimeoutError):
+                client.close()  # the request was cancelled mid-flight, start over on a new connection
+            if isinstance(exc, (asyncio.TimeoutError, pymodbus.exceptions.ModbusIOException)):
+                # No answer at all; exception responses and lost connections do not count against the slave
+                if breaker.record_failure():
+                    self._start_probes()
+            return SlaveResult(slave_id, False, error=exc, **result_args)
+        finally:
+            self._release(client)
+        breaker.record_success()
+        return result
+
+    def _start_probes(self):
+        # Run _probe_loop on the engine loop unless it is running already.
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    async def _probe(self, slave_id):
+        # One guard read of a skipped slave, closes its breaker when it answers.
+        breaker = self._breaker(slave_id)
+        try:
+            client = await self._acquire()
+        except pymodbus.exceptions.ModbusException:
+            breaker.record_failure()
+            return
+        try:
+            await asyncio.wait_for(self._read(client, GUARD_REGISTER, 1, slave_id), self.deadline)
+        except (pymodbus.exceptions.ModbusException, asyncio.TimeoutError) as exc:
+            logging.debug(f"Probe of slave {slave_id} failed: {exc!r}")
+            breaker.record_failure()
+            return
+        finally:
+            self._release(client)
+        self._forget(slave_id)  # its state is unknown after the outage, the next command rewrites everything
+        breaker.record_success()
+
+    async def _probe_loop(self):
+        # Reconnect the gateway and probe open slave breakers in the background until all are closed again.
+        gateway = self.gateway_breaker
+        while True:
+            # Slaves cannot be probed while the gateway is down
+            breakers = [gateway] if gateway.is_open else [breaker for breaker in self.breakers.values()
+                                                           if breaker.is_open]
+            if not breakers:
+                return
+            delay = min(breaker.next_probe_at for breaker in breakers) - gateway.clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif gateway.is_open:
+                try:
+                    self._release(await self._acquire())
+                except pymodbus.exceptions.ModbusException as exc:
+                    logging.debug(f"Reconnect to {self.host}:{self.port} failed: {exc}")
+            else:
+                await asyncio.gather(*(self._probe(slave_id) for slave_id, breaker in self.breakers.items()
+                                       if breaker.probe_due()))
+
+    async def slave_sequence(self, slave_id, flux):
+        # Enable Modbus mode, write the flux and read back the power of one slave.
+        async def sequence(client):
+            await self._guard(client, slave_id)
+            await self._write(client, ENABLE_REGISTER, 1, slave_id)
+            await self._write(client, FLUX_REGISTER, flux, slave_id)
+            values = await read_values_async(lambda address, count: self._read(client, address, count, slave_id),
+                                             POLL_REGISTERS)
+            logging.info(f"Slave {slave_id}: flux {flux}, values {values}")
+            return SlaveResult(slave_id, True, flux=flux, values=values)
+
+        return await self._guarded(slave_id, "sequence", sequence, flux=flux)
+
+    async def slave_read(self, slave_id, names):
+        # Read the named registers of one slave with the fewest block reads.
+        async def read(client):
+            values = await read_values_async(lambda address, count: self._read(client, address, count, slave_id),
+                                             names)
+            return SlaveResult(slave_id, True, values=values)
+
+        return await self._guarded(slave_id, "read", read)
+
+    async def slave_write(self, slave_id, name, value):
+        # Write one named register of one slave.
+        address = REGISTERS[name].address
+
+        async def write(client):
+            await self._guard(client, slave_id)
+            await self._write(client, address, value, slave_id)
+            return SlaveResult(slave_id, True, values={name: value})
+
+        return await self._guarded(slave_id, f"write of {name}", write)
+
+    async def write_all_async(self, slave_ids, name, value):
+        # Write the same value to one named register of all slaves concurrently.
+        results = await asyncio.gather(*(self.slave_write(slave_id, name, value) for slave_id in slave_ids))
+        return {result.slave_id: result for result in results}
+
+    async def write_each_async(self, name, slave_values):
+        # Write {slave_id: value} to one named register of every slave concurrently.
+        results = await asyncio.gather(*(self.slave_write(slave_id, name, value)
+                                         for slave_id, value in slave_values.items()))
+        return {result.slave_id: result for result in results}
+
+    async def read_all_async(self, slave_ids, names):
+        # Read the named registers from all slaves concurrently; returns {slave_id: SlaveResult}.
+        results = await asyncio.gather(*(self.slave_read(slave_id, names) for slave_id in slave_ids))
+        return {result.slave_id: result for result in results}
+
+    async def apply_flux_all_async(self, slave_flux):
+        # Fan the per-slave sequence out over all slaves; returns {slave_id: SlaveResult}.
+        results = await asyncio.gather(*(self.slave_sequence(slave_id, flux)
+                                         for slave_id, flux in slave_flux.items()))
+        return {result.slave_id: result for result in results}
+
+    async def _close_clients(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        for client in self._clients:
+            client.close()
+        self._clients = []
+        self._pool = None
+
+    def close(self):
+        # Close all pooled connections and stop the loop thread.
+        if self._loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_clients(), self._loop).result(timeout=5)
+        except Exception as e:
+            logging.warning(f"Closing Modbus engine connections failed: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+        logging.info("Modbus engine closed.")
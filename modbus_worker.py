@@ -0,0 +1,69 @@
+import collections
+import logging
+import threading
+
+
+class ModbusWorker(threading.Thread):
+    """
+    Single thread that runs all Modbus I/O so the Tk main loop never blocks on a socket.
+    Commands are queued with a coalescing key: a command submitted while another one with the
+    same key is still waiting replaces it, so only the latest brightness for a slave is sent.
+    Results are handed to `dispatch(callback, result)`, which the GUI points at `top.after`
+    so callbacks run on the Tk thread.
+    """
+
+    def __init__(self, dispatch=None):
+        super().__init__(name="modbus-worker", daemon=True)
+        self.dispatch = dispatch or (lambda callback, result: callback(result))
+        self._pending = collections.OrderedDict()  # {key: (func, args, callback)} in submit order
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._sequence = 0  # used as key for commands that must never be coalesced
+
+    def submit(self, key, func, *args, callback=None, replaces=None):
+        """
+        Queue func(*args) under `key` (None = never coalesced). A waiting command with the same key
+        is dropped, as are waiting commands whose key matches the `replaces(key)` predicate.
+        """
+        with self._condition:
+            if self._stopping:
+                logging.warning(f"Modbus worker stopped, command {key} ignored")
+                return
+            if key is None:
+                self._sequence += 1
+                key = ("seq", self._sequence)
+            dropped = [pending for pending in self._pending
+                       if pending == key or (replaces is not None and replaces(pending))]
+            for pending in dropped:
+                del self._pending[pending]
+                logging.debug(f"Modbus command {pending} superseded by {key}")
+            self._pending[key] = (func, args, callback)
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                key, (func, args, callback) = self._pending.popitem(last=False)
+            try:
+                result = func(*args)
+            except Exception as e:
+                logging.exception(f"Modbus command {key} failed: {e}")
+                result = e
+            if callback is not None:
+                try:
+                    self.dispatch(callback, result)
+                except Exception as e:
+                    # e.g. Tk not running (yet or any more); the worker must keep serving commands
+                    logging.error(f"Result of Modbus command {key} could not be dispatched: {e!r}")
+
+    def stop(self, timeout=None):
+        # Finish the commands already queued, then end the thread.
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,167 @@
+"""
+Alerts of the power guardian. The control loop only enqueues; a background thread sends the
+messages through a pluggable backend with a rate limit and retries with exponential backoff.
+Alerts are deduplicated per episode: alert() sends once until recover() ends the episode, which
+sends the recovery message.
+"""
+import logging
+import queue
+import threading
+import time
+
+
+class NotificationError(Exception):
+    pass
+
+
+class CallMeBotBackend:
+    # WhatsApp messages through the CallMeBot API over one pooled session.
+    name = "whatsapp"
+    url = "https://api.callmebot.com/whatsapp.php"
+
+    def __init__(self, phone, api_key, timeout=10, session=None):
+        import requests
+        self.phone = phone
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+    def send(self, text):
+        import requests
+        try:
+            response = self.session.get(self.url, params={'phone': self.phone, 'text': text, 'apikey': self.api_key},
+                                        timeout=self.timeout)
+        except requests.RequestException as e:
+            raise NotificationError(str(e)) from e
+        if response.status_code != 200:
+            raise NotificationError(f"{response.status_code} {response.text}")
+        return len(response.content)
+
+    def close(self):
+        self.session.close()
+
+
+class LogBackend:
+    # Writes the messages to the log only, for installations without WhatsApp.
+    name = "log"
+
+    def send(self, text):
+        logging.warning(f"Notification: {text}")
+        return 0
+
+    def close(self):
+        pass
+
+
+class MemoryBackend:
+    # Keeps the sent messages in `sent`; `fail` makes the next sends fail. For tests and benchmarks.
+    name = "memory"
+
+    def __init__(self):
+        self.sent = []
+        self.fail = 0
+
+    def send(self, text):
+        if self.fail:
+            self.fail -= 1
+            raise NotificationError("simulated failure")
+        self.sent.append(text)
+        return len(text)
+
+    def close(self):
+        pass
+
+
+class NotificationDispatcher:
+    def __init__(self, backend, max_queue=32, min_interval=60, retries=3, backoff=5, metrics=None,
+                 clock=time.monotonic):
+        self.backend = backend
+        self.min_interval = min_interval  # seconds between two sent messages
+        self.retries = retries
+        self.backoff = backoff  # first retry delay, doubled on every attempt
+        self.metrics = metrics
+        self.clock = clock
+        self.active = set()  # events with an alert sent and no recovery yet
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._sent_at = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="notifications", daemon=True)
+        self._thread.start()
+
+    def notify(self, text):
+        # Queue a message without waiting, returns False when the queue is full and it was dropped.
+        try:
+            self._queue.put_nowait(text)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f"Notification queue full, message dropped: {text}")
+            return False
+
+    def alert(self, event, text):
+        # Send text once per episode of `event`; a dropped alert is tried again on the next call.
+        with self._lock:
+            if event in self.active or not self.notify(text):
+                return False
+            self.active.add(event)
+        return True
+
+    def recover(self, event, text):
+        # End the episode of `event`, sending text if an alert was sent for it.
+        with self._lock:
+            if event not in self.active:
+                return False
+            self.active.discard(event)
+        return self.notify(text)
+
+    def _send(self, text):
+        # One message with retries, returns True when it was delivered.
+        for attempt in range(self.retries + 1):
+            if self._sent_at is not None:
+                wait = self.min_interval - (self.clock() - self._sent_at)
+                if wait > 0 and self._stopped.wait(wait):
+                    return False
+            started = time.perf_counter()
+            try:
+                size = self.backend.send(text)
+            except NotificationError as e:
+                if self.metrics is not None:
+                    self.metrics.observe_http(self.backend.name, time.perf_counter() - started, error=e)
+                logging.error(f"Sending notification failed (attempt {attempt + 1}): {e}")
+                if attempt < self.retries and self._stopped.wait(self.backoff * 2 ** attempt):
+                    return False
+                continue
+            self._sent_at = self.clock()  # only delivered messages count against the rate limit
+            if self.metrics is not None:
+                self.metrics.observe_http(self.backend.name, time.perf_counter() - started, size)
+            logging.info("Message sent successfully!")
+            return True
+        logging.error(f"Notification given up after {self.retries + 1} attempts: {text}")
+        return False
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                text = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._send(text)
+            self._queue.task_done()
+
+    def flush(self, timeout=None):
+        # Wait until the queued messages are sent or given up (for tests and shutdown).
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=5):
+        # Give the queued messages `timeout` seconds, then stop the thread.
+        self.flush(timeout)
+        self._stopped.set()
+        self._thread.join(timeout)
+        self.backend.close()
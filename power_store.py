@@ -0,0 +1,211 @@
+"""
+Power history of every slave. Recent samples live in a fixed-size ring buffer per slave and are
+flushed to append-only files of fixed-size binary records, one file per UTC day and resolution:
+
+    <path>/raw/20240601.bin    raw samples (time, slave, watts)
+    <path>/1m/20240601.bin     rollups (bucket start, slave, count, mean, min, max)
+    <path>/15m/..., <path>/1h/...
+
+Rollups are accumulated incrementally as samples arrive. Reads memory-map the day files, so a
+day range query is a NumPy mask over a few hundred kilobytes. Day files older than the
+retention of their resolution are deleted, which bounds the disk use.
+"""
+import calendar
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+RAW_DTYPE = np.dtype([("time", "<f8"), ("slave", "<u2"), ("watts", "<f4")])
+ROLLUP_DTYPE = np.dtype([("time", "<f8"), ("slave", "<u2"), ("count", "<u2"), ("mean", "<f4"), ("min", "<f4"),
+                         ("max", "<f4")])
+ROLLUPS = {"1m": 60, "15m": 900, "1h": 3600}
+DEFAULT_RETENTION_DAYS = {"raw": 14, "1m": 90, "15m": 730, "1h": 3650}
+
+
+class RingBuffer:
+    # Last `capacity` (time, value) samples in two preallocated arrays.
+    def __init__(self, capacity=4096):
+        self.times = np.zeros(capacity, dtype="<f8")
+        self.values = np.zeros(capacity, dtype="<f4")
+        self.capacity = capacity
+        self.size = 0
+        self._next = 0
+
+    def append(self, timestamp, value):
+        self.times[self._next] = timestamp
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def latest(self, count=None):
+        # The newest `count` samples (default all) in time order, as (times, values) copies.
+        count = self.size if count is None else min(count, self.size)
+        index = (np.arange(self._next - count, self._next)) % self.capacity
+        return self.times[index], self.values[index]
+
+
+class PowerStore:
+    def __init__(self, path, capacity=4096, flush_seconds=60, retention_days=None, clock=time.time):
+        self.path = path
+        self.capacity = capacity
+        self.flush_seconds = flush_seconds
+        self.retention_days = dict(DEFAULT_RETENTION_DAYS, **(retention_days or {}))
+        self.clock = clock
+        self.buffers = {}  # {slave index: RingBuffer}
+        self._unflushed = {}  # {slave index: samples not written yet}
+        self._accumulators = {}  # {(resolution, slave index): [bucket start, count, sum, min, max]}
+        self._pending_rollups = {name: [] for name in ROLLUPS}
+        self._flushed_at = clock()
+        self._pruned_day = None
+        self._lock = threading.RLock()
+        for name in ("raw", *ROLLUPS):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+        self._index_path = os.path.join(path, "slaves.json")
+        self._slave_index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding="utf-8") as f:
+                self._slave_index = json.load(f)
+
+    def _index(self, key):
+        # Small integer id of a slave key, stored in slaves.json so it survives restarts.
+        name = f"{key[0]}/{key[1]}"
+        if name not in self._slave_index:
+            self._slave_index[name] = len(self._slave_index)
+            with open(self._index_path, "w", encoding="utf-8") as f:
+                json.dump(self._slave_index, f)
+        return self._slave_index[name]
+
+    def record(self, key, watts, timestamp=None):
+        # Add one power sample of slave `key`, flushing to disk every flush_seconds.
+        timestamp = self.clock() if timestamp is None else timestamp
+        with self._lock:
+            index = self._index(key)
+            buffer = self.buffers.get(index)
+            if buffer is None:
+                buffer = self.buffers[index] = RingBuffer(self.capacity)
+            buffer.append(timestamp, watts)
+            self._unflushed[index] = min(self._unflushed.get(index, 0) + 1, self.capacity)
+            for name, seconds in ROLLUPS.items():
+                self._accumulate(name, seconds, index, timestamp, watts)
+            if (self.clock() - self._flushed_at >= self.flush_seconds
+                    or self._unflushed[index] >= self.capacity // 2):
+                self.flush()
+
+    def record_results(self, results, timestamp=None):
+        # Record the power of every successful {key: SlaveResult}.
+        for key, result in results.items():
+            if result.success and result.power is not None:
+                self.record(key, result.power, timestamp)
+
+    def _accumulate(self, name, seconds, index, timestamp, watts):
+        bucket = timestamp - timestamp % seconds
+        accumulator = self._accumulators.get((name, index))
+        if accumulator is not None and accumulator[0] != bucket:
+            start, count, total, low, high = accumulator
+            self._pending_rollups[name].append((start, index, count, total / count, low, high))
+            accumulator = None
+        if accumulator is None:
+            self._accumulators[(name, index)] = [bucket, 1, watts, watts, watts]
+        else:
+            accumulator[1] += 1
+            accumulator[2] += watts
+            accumulator[3] = min(accumulator[3], watts)
+            accumulator[4] = max(accumulator[4], watts)
+
+    def _append(self, name, records):
+        # Append records to the day files of their UTC date.
+        days = (records["time"] // 86400).astype(np.int64)
+        for day in np.unique(days):
+            path = os.path.join(self.path, name, time.strftime("%Y%m%d", time.gmtime(int(day) * 86400)) + ".bin")
+            with open(path, "ab") as f:
+                f.write(records[days == day].tobytes())
+
+    def flush(self):
+        # Write the unflushed samples and the completed rollup buckets, then apply the retention.
+        with self._lock:
+            raw = []
+            for index, count in self._unflushed.items():
+                times, values = self.buffers[index].latest(count)
+                samples = np.empty(len(times), dtype=RAW_DTYPE)
+                samples["time"], samples["slave"], samples["watts"] = times, index, values
+                raw.append(samples)
+            if raw:
+                self._append("raw", np.concatenate(raw))
+            for name, pending in self._pending_rollups.items():
+                if pending:
+                    self._append(name, np.array(pending, dtype=ROLLUP_DTYPE))
+            self._unflushed.clear()
+            self._pending_rollups = {name: [] for name in ROLLUPS}
+            self._flushed_at = self.clock()
+            if self._pruned_day != int(self._flushed_at // 86400):
+                self.prune()
+
+    def prune(self):
+        # Delete day files older than the retention of their resolution.
+        today = self._pruned_day = int(self.clock() // 86400)
+        for name, days in self.retention_days.items():
+            directory = os.path.join(self.path, name)
+            for file_name in os.listdir(directory):
+                try:
+                    day = calendar.timegm(time.strptime(file_name[:8], "%Y%m%d")) // 86400
+                except ValueError:
+                    continue
+                if today - day > days:
+                    os.remove(os.path.join(directory, file_name))
+                    logging.info(f"Power history {name}/{file_name} removed after {days} days")
+
+    def _read_day(self, name, day, dtype):
+        path = os.path.join(self.path, name, time.strftime("%Y%m%d", time.gmtime(day * 86400)) + ".bin")
+        try:
+            records = os.path.getsize(path) // dtype.itemsize  # a torn last record is ignored
+        except OSError:
+            return np.empty(0, dtype=dtype)
+        if not records:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(records,))
+
+    def query(self, key, start, end, resolution="1m"):
+        """
+        Records of slave `key` with start <= time < end: RAW_DTYPE for "raw", else ROLLUP_DTYPE
+        records of the completed buckets of resolution "1m", "15m" or "1h".
+        """
+        dtype = RAW_DTYPE if resolution == "raw" else ROLLUP_DTYPE
+        with self._lock:
+            name = f"{key[0]}/{key[1]}"
+            if name not in self._slave_index:
+                return np.empty(0, dtype=dtype)
+            index = self._slave_index[name]
+            parts = []
+            for day in range(int(start // 86400), int(end // 86400) + 1):
+                records = self._read_day(resolution, day, dtype)
+                parts.append(records[(records["slave"] == index) & (records["time"] >= start)
+                                     & (records["time"] < end)])
+            # Samples not on disk yet
+            if resolution == "raw":
+                times, values = self.buffers[index].latest(self._unflushed.get(index, 0)) \
+                    if index in self.buffers else ([], [])
+                pending = np.empty(len(times), dtype=RAW_DTYPE)
+                pending["time"], pending["slave"], pending["watts"] = times, index, values
+            else:
+                pending = np.array([record for record in self._pending_rollups[resolution] if record[1] == index],
+                                   dtype=ROLLUP_DTYPE)
+            parts.append(pending[(pending["time"] >= start) & (pending["time"] < end)])
+        return np.concatenate(parts)
+
+    def series(self, key, start, end, max_points=1500):
+        # (times, mean watts) of the finest rollup with at most max_points buckets, for plotting.
+        resolution = next((name for name, seconds in ROLLUPS.items() if (end - start) / seconds <= max_points), "1h")
+        records = self.query(key, start, end, resolution)
+        return records["time"], records["mean"]
+
+    def close(self):
+        # Flush everything including the open buckets; after a restart the same bucket may get a second record.
+        with self._lock:
+            for (name, index), (start, count, total, low, high) in self._accumulators.items():
+                self._pending_rollups[name].append((start, index, count, total / count, low, high))
+            self._accumulators.clear()
+            self.flush()
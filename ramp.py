@@ -0,0 +1,167 @@
+"""
+Brightness fades. A ramp moves the flux of one slave linearly from its current value to a target
+over a given time; a background thread turns all running ramps into intermediate flux writes.
+Every gateway has a write budget (writes per second, token bucket), and within the budget the slaves
+whose flux is furthest behind their ramp go first, so the slaves of a gateway advance interleaved.
+"""
+import logging
+import threading
+import time
+
+from modbus_engine import FLUX_REGISTER
+
+
+class Ramp:
+    def __init__(self, start_flux, target_flux, started, duration):
+        self.start_flux = start_flux
+        self.target_flux = target_flux
+        self.started = started
+        self.duration = duration
+
+    def flux_at(self, now):
+        if self.duration <= 0 or now >= self.started + self.duration:
+            return self.target_flux
+        progress = max(0.0, (now - self.started) / self.duration)
+        return int(round(self.start_flux + (self.target_flux - self.start_flux) * progress))
+
+    def finished(self, now):
+        return now >= self.started + self.duration
+
+
+class RampEngine:
+    def __init__(self, fleet, writes_per_second=20, min_step=5, tick=0.2, clock=time.monotonic, background=True):
+        self.fleet = fleet
+        self.writes_per_second = writes_per_second  # budget of intermediate writes per gateway
+        self.min_step = min_step  # smaller flux changes wait for the next tick
+        self.tick = tick
+        self.clock = clock
+        self.background = background  # False: no thread, the caller drives step() (tests)
+        self.ramps = {}  # {key: Ramp}
+        self.written = {}  # {key: last flux written by a ramp}
+        self._tokens = {}  # {gateway name: available writes}
+        self._budget_at = None
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()  # held while intermediate writes are in flight
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def current_flux(self, key, now):
+        # Flux the slave is at: the running ramp, else the last value known from the device cache.
+        ramp = self.ramps.get(key)
+        if ramp is not None:
+            return self.written.get(key, ramp.start_flux)
+        gateway_name, slave_id = key
+        return self.fleet.gateways[gateway_name].cache.last_known(slave_id, FLUX_REGISTER)
+
+    def start(self, slave_flux, duration):
+        """
+        Fade {key: flux} over `duration` seconds and return the {key: SlaveResult} of the first step,
+        which enables Modbus mode at the current flux (slaves with an unknown flux jump to the target).
+        A new ramp for a slave that is still ramping continues from where the old one got to.
+        """
+        now = self.clock()
+        first = {}
+        with self._lock:
+            for key, target in slave_flux.items():
+                ramp = self.ramps.get(key)
+                if ramp is not None and ramp.target_flux == target:
+                    first[key] = self.written.get(key, ramp.start_flux)  # same fade already running
+                    continue
+                current = self.current_flux(key, now)
+                if current is None or current == target or duration <= 0:
+                    self.ramps.pop(key, None)
+                    self.written.pop(key, None)
+                    first[key] = target
+                else:
+                    self.ramps[key] = Ramp(current, target, now, duration)
+                    self.written[key] = current
+                    first[key] = current
+        results = self.fleet.apply_flux_all(first)
+        with self._lock:
+            for key, result in results.items():
+                if not result.success:
+                    self.ramps.pop(key, None)
+                    self.written.pop(key, None)
+            if self.ramps and self.background:
+                self._ensure_thread()
+                self._wake.set()
+        return results
+
+    def cancel(self, keys=None):
+        # Stop the ramps of the given slaves (default all) where they are.
+        with self._lock:
+            for key in list(self.ramps) if keys is None else keys:
+                self.ramps.pop(key, None)
+                self.written.pop(key, None)
+        # A write already in flight must land before whatever the caller writes next
+        with self._io_lock:
+            pass
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="ramp-engine", daemon=True)
+            self._thread.start()
+
+    def _refill(self, now):
+        elapsed = 0 if self._budget_at is None else now - self._budget_at
+        self._budget_at = now
+        for gateway_name in self.fleet.gateways:
+            tokens = self._tokens.get(gateway_name, self.writes_per_second)
+            self._tokens[gateway_name] = min(self.writes_per_second, tokens + elapsed * self.writes_per_second)
+
+    def plan_writes(self, now):
+        # {key: flux} to write on this tick, within the write budget of every gateway.
+        with self._lock:
+            self._refill(now)
+            due = {}
+            for key, ramp in self.ramps.items():
+                flux = ramp.flux_at(now)
+                behind = abs(flux - self.written[key])
+                if behind >= self.min_step or (ramp.finished(now) and behind):
+                    due.setdefault(key[0], []).append((behind, key, flux))
+            writes = {}
+            for gateway_name, candidates in due.items():
+                budget = int(self._tokens[gateway_name])
+                for behind, key, flux in sorted(candidates, key=lambda candidate: -candidate[0])[:budget]:
+                    writes[key] = flux
+                self._tokens[gateway_name] -= min(budget, len(candidates))
+            return writes
+
+    def step(self, now):
+        # One tick: send the due writes and drop the finished ramps, returns False when no ramp is left.
+        # Planned under the I/O lock too: once cancel() returns no write of a cancelled ramp is left
+        with self._io_lock:
+            writes = self.plan_writes(now)
+            results = self.fleet.write_each("flux", writes) if writes else {}
+        with self._lock:
+            for key, result in results.items():
+                if key not in self.ramps:
+                    continue  # replaced while writing
+                if not result.success:
+                    logging.error(f"Ramp of {key} stopped: {result.error}")
+                    self.ramps.pop(key)
+                    self.written.pop(key)
+                else:
+                    self.written[key] = writes[key]
+            for key, ramp in list(self.ramps.items()):
+                if ramp.finished(now) and self.written[key] == ramp.target_flux:
+                    del self.ramps[key]
+                    del self.written[key]
+            if not self.ramps:
+                self._wake.clear()  # under the lock, a start() after this sets it again
+                return False
+            return True
+
+    def _run(self):
+        while not self._stopped:
+            if self.step(self.clock()):
+                time.sleep(self.tick)
+            else:
+                self._wake.wait()
+
+    def stop(self):
+        self.cancel()
+        self._stopped = True
+        self._wake.set()
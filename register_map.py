@@ -0,0 +1,95 @@
+"""
+Declarative map of the holding registers used on the dimming modules and a planner that merges
+the registers needed in one cycle into as few contiguous block reads as possible.
+"""
+
+
+class Register:
+    # One logical value stored in `width` consecutive 16 bit holding registers (high word first).
+    def __init__(self, name, address, width=1, scale=1, signed=False):
+        self.name = name
+        self.address = address
+        self.width = width
+        self.scale = scale
+        self.signed = signed
+
+    @property
+    def end(self):
+        return self.address + self.width
+
+    def decode(self, words):
+        # Combine the words as high << 16 | low and apply sign and scaling.
+        value = 0
+        for word in words:
+            value = (value << 16) | (word & 0xFFFF)
+        if self.signed and value >= 1 << (16 * self.width - 1):
+            value -= 1 << (16 * self.width)
+        return value * self.scale if self.scale != 1 else value
+
+    def __repr__(self):
+        return f"Register({self.name!r}, {self.address}, width={self.width})"
+
+
+REGISTERS = {register.name: register for register in (
+    Register("enable", 25),  # 1 = controlled over Modbus
+    Register("flux", 38),  # flux set point, 0..mflux
+    Register("guard", 132),  # read before writes to check the module answers
+    Register("percentage", 256),  # actual brightness reported by the module
+    Register("power", 257, width=2),  # electric power of the luminaires in W
+)}
+
+MAX_GAP = 4  # unused registers we accept reading to save a round trip
+MAX_COUNT = 125  # holding registers per read request allowed by the Modbus PDU
+
+
+class ReadBlock:
+    # A single read_holding_registers request covering one or more registers.
+    def __init__(self, address, count, registers):
+        self.address = address
+        self.count = count
+        self.registers = registers
+
+    def decode(self, words):
+        # Slice the block response into the registers it covers, returns {name: value}.
+        return {register.name: register.decode(words[register.address - self.address:
+                                                     register.end - self.address])
+                for register in self.registers}
+
+    def __repr__(self):
+        return f"ReadBlock({self.address}, {self.count}, {[r.name for r in self.registers]})"
+
+
+def plan_reads(names, register_map=None, max_gap=MAX_GAP, max_count=MAX_COUNT):
+    """
+    Merge the named registers into the fewest contiguous block reads.
+    Two registers end up in one block when the hole between them is at most `max_gap`
+    registers and the block stays within `max_count` registers.
+    """
+    register_map = register_map or REGISTERS
+    registers = sorted({register_map[name] for name in names}, key=lambda r: r.address)
+    blocks = []
+    for register in registers:
+        if blocks:
+            block = blocks[-1]
+            block_end = block.address + block.count
+            new_end = max(block_end, register.end)
+            if register.address - block_end <= max_gap and new_end - block.address <= max_count:
+                block.count = new_end - block.address
+                block.registers.append(register)
+                continue
+        blocks.append(ReadBlock(register.address, register.width, [register]))
+    return blocks
+
+
+async def read_values_async(read_fn, names, register_map=None):
+    """
+    Read and decode the named registers with a coroutine `read_fn(address, count)` returning
+    the list of words, or None when the read failed. Returns {name: value} or None.
+    """
+    values = {}
+    for block in plan_reads(names, register_map):
+        words = await read_fn(block.address, block.count)
+        if words is None:
+            return None
+        values.update(block.decode(words))
+    return values
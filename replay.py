@@ -0,0 +1,358 @@
+"""
+Fast-forward replay of the automatic control over recorded limits tables. The recording is the
+JSON lines file written by ApiSnapshot with `api_record_path` set, one {"time", "rows"} table per
+change. The real control step (zone evaluation, AdaptiveScheduler, grid limit guard) runs on a
+virtual clock, polling every poll_seconds, against an in-memory stand-in of the Modbus fleet, so
+months of data take seconds. Parameter sets are evaluated in parallel in a process pool:
+
+    python replay.py limits.jsonl --config config.json --margin 50 100 150 --factor 0.8 0.9
+
+For every set it reports the lamp energy, the grid limit breaches and the Modbus writes.
+
+The recorded import was measured with the lamps running on the parameters of the config. A first
+replay with those parameters gives the reference lamp power, and every other replay sees the
+recorded import corrected by how much more or less power its lamps draw. Fades are not simulated,
+brightness changes are applied at once.
+"""
+import argparse
+import bisect
+import itertools
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from control_core import ControlCore, load_config
+from fleet import Slave
+from modbus_engine import SlaveResult
+
+IMPORT_ROW = 9  # [name, kW, -, limit MW]
+EXPORT_ROW = 10
+
+
+def load_recording(path):
+    # [(unix time, rows)] of a JSON lines recording, in time order.
+    recording = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                recording.append((entry["time"], entry["rows"]))
+    recording.sort(key=lambda entry: entry[0])
+    return recording
+
+
+class VirtualClock:
+    # Time of the replay, set by the replay loop; passed as `clock` where the real code reads the time.
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ReplaySnapshot:
+    """
+    Stand-in of ApiSnapshot serving the recorded table in effect at the virtual time.
+    `import_offset` kW are added to the recorded linear import.
+    """
+
+    def __init__(self, recording, clock):
+        self.times = [timestamp for timestamp, rows in recording]
+        self.tables = [rows for timestamp, rows in recording]
+        self.clock = clock
+        self.index = -1  # index of the table in effect
+        self.rows = None
+        self.import_offset = 0.0
+
+    def refresh(self, force=False):
+        index = bisect.bisect_right(self.times, self.clock()) - 1
+        if index != self.index:
+            self.index = index
+            self.rows = self.tables[index] if index >= 0 else None
+        return self.rows
+
+    def cell(self, row_val, data_val):
+        rows = self.rows
+        if rows is None:
+            return None
+        if not (row_val < len(rows) and data_val < len(rows[row_val])):
+            return None
+        value = rows[row_val][data_val]
+        if row_val == IMPORT_ROW and data_val == 1 and self.import_offset:
+            value = max(0.0, float(value) + self.import_offset)
+        return value
+
+    def close(self):
+        pass
+
+
+class VirtualGateway:
+    # Name and slaves of a gateway, without a connection.
+    def __init__(self, name):
+        self.name = name
+        self.slaves = []
+
+    def add_slave(self, slave_id, name, api_row):
+        slave = Slave(self, slave_id, name, api_row)
+        self.slaves.append(slave)
+        return slave
+
+
+class SimulatedFleet:
+    """
+    In-memory stand-in of Fleet for the replay. Every slave behaves like simulator.SimulatedModule:
+    in Modbus mode it reports percentage = flux * 100 // mflux and power = watts_at_full * percentage // 100,
+    in local mode full power. Writes are counted like the real engine does them: enable only when the
+    slave is not in Modbus mode yet and flux only when the value changes (the others are suppressed).
+    """
+
+    def __init__(self, gateways, mflux=1000, watts_at_full=600):
+        self.gateways = {gateway.name: gateway for gateway in gateways}
+        self.mflux = mflux
+        self.watts_at_full = watts_at_full
+        self.enabled = {}  # {key: True in Modbus mode}
+        self.flux = {}  # {key: last written flux}
+        self.power = {slave.key: watts_at_full for slave in self.slaves}
+        self.watts = float(sum(self.power.values()))  # total power of all slaves
+        self.writes = 0
+        self.suppressed = 0
+
+    @classmethod
+    def from_config(cls, config, watts_at_full=600):
+        gateways = []
+        for gateway_config in config["gateways"]:
+            gateway = VirtualGateway(gateway_config.get("name") or gateway_config["host"])
+            for slave_config in gateway_config["slaves"]:
+                slave_id = int(slave_config["id"])
+                gateway.add_slave(slave_id, slave_config.get("name", f"Module {slave_id}"),
+                                  slave_config.get("api_row"))
+            gateways.append(gateway)
+        return cls(gateways, config["mflux"], watts_at_full)
+
+    @property
+    def slaves(self):
+        return [slave for gateway in self.gateways.values() for slave in gateway.slaves]
+
+    def _update(self, key):
+        flux = self.flux.get(key, self.mflux) if self.enabled.get(key) else self.mflux
+        percentage = min(100, flux * 100 // self.mflux)
+        power = self.watts_at_full * percentage // 100
+        self.watts += power - self.power[key]
+        self.power[key] = power
+        return SlaveResult(key[1], True, flux, {"percentage": percentage, "power": power})
+
+    def _write(self, key, name, value):
+        if name == "enable":
+            if self.enabled.get(key, False) == bool(value):
+                self.suppressed += 1
+                return self._update(key)
+            self.enabled[key] = bool(value)
+        elif name == "flux":
+            if self.flux.get(key) == value:
+                self.suppressed += 1
+                return self._update(key)
+            self.flux[key] = value
+        self.writes += 1
+        return self._update(key)
+
+    def apply_flux_all(self, slave_flux):
+        results = {}
+        for key, flux in slave_flux.items():
+            self._write(key, "enable", 1)
+            results[key] = self._write(key, "flux", flux)
+        return results
+
+    def read_all(self, names, keys=None):
+        keys = keys if keys is not None else [slave.key for slave in self.slaves]
+        return {key: self._update(key) for key in keys}
+
+    def write_all(self, name, value, keys=None):
+        keys = keys if keys is not None else [slave.key for slave in self.slaves]
+        return {key: self._write(key, name, value) for key in keys}
+
+    def write_each(self, name, values):
+        return {key: self._write(key, name, value) for key, value in values.items()}
+
+    def take_suppressed(self):
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+    def close(self):
+        pass
+
+
+class ReplayCore(ControlCore):
+    """
+    ControlCore on the replay stand-ins. The zone evaluation is reused while the table and the import
+    correction do not change, the grid limit guard is counted instead of sending alerts, and
+    `over_limit` tells whether the (corrected) import or export is above its limit.
+    """
+
+    def __init__(self, config, fleet, api_snapshot):
+        # No metrics server, power history or table recording: they would clash with the live service
+        config = dict(config, metrics_port=None, power_store_path=None, api_record_path=None)
+        super().__init__(config, fleet=fleet, api_snapshot=api_snapshot)
+        self.guard_trips = 0  # times the guard started reducing the brightness
+        self.over_limit = False
+        self._guard = False
+        self._evaluated = None
+        self._evaluated_for = None
+
+    def evaluate_zones(self):
+        snapshot = self.api_snapshot
+        inputs = (snapshot.index, snapshot.import_offset)
+        if inputs != self._evaluated_for:
+            self._evaluated = super().evaluate_zones()
+            self._evaluated_for = inputs
+            if self._evaluated is not None:
+                self.over_limit = (float(self.fetch_and_parse(IMPORT_ROW, 1))
+                                   > float(self.fetch_and_parse(IMPORT_ROW, 3).replace(',', '.')) * 1000
+                                   or float(self.fetch_and_parse(EXPORT_ROW, 1))
+                                   > float(self.fetch_and_parse(EXPORT_ROW, 3).replace(',', '.')) * 1000)
+        return self._evaluated
+
+    def notify_breach(self, breach):
+        if breach and not self._guard:
+            self.guard_trips += 1
+        self._guard = breach
+
+
+def replay(recording, config, reference=None, watts_at_full=600, fast_forward=True):
+    """
+    Run the auto control over the recording with `config`, returns (results, power): a dict with
+    energy_kwh, breaches (episodes over the import/export limit), breach_hours, guard_trips, writes and
+    polls, and the total lamp power in W at every poll. With `reference` (the power of a replay with the
+    recorded parameters) the import is corrected by the power difference to it.
+    With fast_forward, a poll that applied nothing is followed directly by the next poll where something
+    can change: a new table, a change of the reference power, a resync or the end of a dwell time.
+    """
+    clock = VirtualClock(recording[0][0])
+    snapshot = ReplaySnapshot(recording, clock)
+    fleet = SimulatedFleet.from_config(config, watts_at_full)
+    core = ReplayCore(config, fleet, snapshot)
+    scheduler = core.create_scheduler(clock=clock)
+    poll_seconds = config["poll_seconds"]
+    start = recording[0][0]
+    polls = int((recording[-1][0] - start) // poll_seconds) + 1
+    power = np.empty(polls)
+    # Polls at which the reference power changes
+    reference_changes = np.flatnonzero(np.diff(reference)) + 1 if reference is not None else np.empty(0, int)
+    breaches = breach_polls = 0
+    over_limit = False
+
+    def apply(percentages, ramp_seconds=0, on_results=None):
+        core.apply_percentages(percentages, on_results=on_results)  # fades are not simulated
+
+    poll = 0
+    while poll < polls:
+        clock.now = start + poll * poll_seconds
+        if reference is not None:
+            snapshot.import_offset = (fleet.watts - reference[poll]) / 1000
+        planned = core.auto_control_step(scheduler, apply)
+        next_poll = poll + 1
+        if fast_forward and not planned:
+            wake_at = scheduler.next_plan_at if scheduler.next_plan_at is not None else float("inf")
+            if snapshot.index + 1 < len(snapshot.times):
+                wake_at = min(wake_at, snapshot.times[snapshot.index + 1])
+            next_poll = max(next_poll, min(polls, int(np.ceil((wake_at - start) / poll_seconds))))
+            change = np.searchsorted(reference_changes, poll, side="right")
+            if change < len(reference_changes):
+                next_poll = min(next_poll, int(reference_changes[change]))
+        # Nothing changes until next_poll
+        power[poll:next_poll] = fleet.watts
+        if core.over_limit:
+            breach_polls += next_poll - poll
+            breaches += not over_limit
+        over_limit = core.over_limit
+        poll = next_poll
+    results = {
+        "energy_kwh": float(power.sum()) * poll_seconds / 3.6e6,
+        "breaches": breaches,
+        "breach_hours": breach_polls * poll_seconds / 3600,
+        "guard_trips": core.guard_trips,
+        "writes": fleet.writes,
+        "polls": polls,
+    }
+    core.close()
+    return results, power
+
+
+_worker = {}
+
+
+def _init_worker(recording_path, config, reference, watts_at_full):
+    _worker.update(recording=load_recording(recording_path), config=config, reference=reference,
+                   watts_at_full=watts_at_full)
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def _replay_parameters(parameters):
+    config = dict(_worker["config"], **parameters)
+    results, power = replay(_worker["recording"], config, _worker["reference"], _worker["watts_at_full"])
+    return results
+
+
+def evaluate(recording_path, config, parameter_sets, watts_at_full=600, workers=None):
+    """
+    Replay the recording once per parameter set (a dict of config overrides, e.g. base_percentages,
+    breach_margin, breach_factor) in a process pool, returns [(parameters, results)] in input order.
+    """
+    recording = load_recording(recording_path)
+    if not recording:
+        raise ValueError(f"No limits tables in {recording_path}")
+    reference_results, reference = replay(recording, config, watts_at_full=watts_at_full)
+    logging.info(f"Reference replay of {len(recording)} tables, {reference_results['polls']} polls: "
+                 f"{reference_results}")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(recording_path, config, reference, watts_at_full)) as executor:
+        return list(zip(parameter_sets, executor.map(_replay_parameters, parameter_sets)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded limits tables against parameter sets")
+    parser.add_argument("recording", help="JSON lines file written with api_record_path")
+    parser.add_argument("--config", help="JSON file overriding the defaults in control_core.DEFAULT_CONFIG")
+    parser.add_argument("--params", help="JSON file with a list of parameter sets (config overrides)")
+    parser.add_argument("--percentages", nargs="+", default=[],
+                        help="base_percentages to try, each as a comma separated list, e.g. 100,80,60,40,20")
+    parser.add_argument("--margin", type=float, nargs="+", default=[], help="breach_margin values to try (kW)")
+    parser.add_argument("--factor", type=float, nargs="+", default=[], help="breach_factor values to try")
+    parser.add_argument("--watts", type=float, default=600, help="power of one slave at full brightness (W)")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    config = load_config(args.config)
+    if args.params:
+        with open(args.params, encoding="utf-8") as f:
+            parameter_sets = json.load(f)
+    else:
+        # Every combination of the given values, the config value for the others
+        grid = {
+            "base_percentages": [[float(value) for value in percentages.split(",")]
+                                 for percentages in args.percentages] or [config["base_percentages"]],
+            "breach_margin": args.margin or [config["breach_margin"]],
+            "breach_factor": args.factor or [config["breach_factor"]],
+        }
+        parameter_sets = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+    evaluated = evaluate(args.recording, config, parameter_sets, args.watts, args.workers)
+    if args.json:
+        print(json.dumps([{"parameters": parameters, "results": results} for parameters, results in evaluated],
+                         indent=2))
+        return
+    print(f"{'base_percentages':<28}{'margin':>8}{'factor':>8}{'energy kWh':>12}{'breaches':>10}"
+          f"{'breach h':>10}{'guard trips':>13}{'writes':>9}")
+    for parameters, results in evaluated:
+        merged = dict(config, **parameters)
+        percentages = ",".join(f"{value:g}" for value in merged["base_percentages"])
+        print(f"{percentages:<28}{merged['breach_margin']:>8g}{merged['breach_factor']:>8g}"
+              f"{results['energy_kwh']:>12.1f}{results['breaches']:>10}{results['breach_hours']:>10.1f}"
+              f"{results['guard_trips']:>13}{results['writes']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Decides which slaves get a new brightness on each poll of the limits API. The control loop polls
+every few seconds; a slave is only rewritten when its zone inputs moved beyond a threshold and the
+new percentage differs enough from the applied one (hysteresis), and not before it has held its
+current value for a minimum dwell time. A grid limit breach bypasses all of that.
+"""
+import time
+
+from modbus_engine import CircuitOpenError
+
+
+class SlaveState:
+    # What was last applied to one slave and the inputs it was computed from.
+    def __init__(self, percentage, par_value, limits, breach, applied_at):
+        self.percentage = percentage
+        self.par_value = par_value
+        self.limits = limits
+        self.breach = breach
+        self.applied_at = applied_at
+
+
+class AdaptiveScheduler:
+    def __init__(self, par_threshold=10, hysteresis=2, min_dwell=60, resync_seconds=300, clock=time.monotonic):
+        self.par_threshold = par_threshold  # PAR change that triggers a recompute
+        self.hysteresis = hysteresis  # minimum percentage change worth a write
+        self.min_dwell = min_dwell  # seconds a slave keeps its value before the next change
+        self.resync_seconds = resync_seconds  # every slave is rewritten at least this often
+        self.clock = clock
+        self.states = {}  # {key: SlaveState}
+        self.breach = False
+        self.resynced_at = None
+        self.next_plan_at = None  # until then plan() with unchanged inputs returns nothing
+
+    def inputs_changed(self, state, par_value, limits, breach):
+        return (abs(par_value - state.par_value) >= self.par_threshold or limits != state.limits
+                or breach != state.breach)
+
+    def plan(self, percentages, zone_inputs, breach):
+        """
+        Return the subset of {key: percentage} to apply now. zone_inputs is {key: (PAR, limits)}
+        of this poll and breach tells whether the grid import/export limit is exceeded.
+        The returned values are recorded as applied; report failed writes with forget_failed().
+        """
+        now = self.clock()
+        breach_started = breach and not self.breach
+        self.breach = breach
+        resync = self.resynced_at is None or now - self.resynced_at >= self.resync_seconds
+        if resync:
+            self.resynced_at = now
+        self.next_plan_at = self.resynced_at + self.resync_seconds
+
+        planned = {}
+        for key, percentage in percentages.items():
+            par_value, limits = zone_inputs[key]
+            state = self.states.get(key)
+            if state is None or breach_started or resync:
+                planned[key] = percentage
+            elif (self.inputs_changed(state, par_value, limits, breach)
+                  and abs(percentage - state.percentage) >= self.hysteresis):
+                if now - state.applied_at < self.min_dwell:
+                    # Waits for its dwell time
+                    self.next_plan_at = min(self.next_plan_at, state.applied_at + self.min_dwell)
+                    continue
+                planned[key] = percentage
+            else:
+                continue
+            self.states[key] = SlaveState(percentage, par_value, limits, breach, now)
+        return planned
+
+    def forget_failed(self, results):
+        # Drop the state of the slaves whose {key: SlaveResult} failed, so the next plan() applies them again.
+        # Slaves skipped by their circuit breaker are left to the breaker's background probe.
+        for key, result in results.items():
+            if not result.success and not isinstance(result.error, CircuitOpenError):
+                self.states.pop(key, None)
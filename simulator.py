@@ -0,0 +1,202 @@
+"""
+Local stand-ins for the hardware and the limits API, used by the benchmarks and for testing
+without a network: a Modbus TCP gateway built on the pymodbus server that emulates the dimming
+modules, and an HTTP stub serving the limits table.
+"""
+import asyncio
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+
+from pymodbus.datastore import ModbusServerContext, ModbusSequentialDataBlock, ModbusSlaveContext
+from pymodbus.server import ModbusTcpServer
+
+from register_map import REGISTERS
+
+ENABLE_REGISTER = REGISTERS["enable"].address
+FLUX_REGISTER = REGISTERS["flux"].address
+GUARD_REGISTER = REGISTERS["guard"].address
+PERCENTAGE_REGISTER = REGISTERS["percentage"].address
+POWER_REGISTER = REGISTERS["power"].address
+READ_FUNCTION_CODES = (3, 4)
+
+
+class SimulatedModule(ModbusSlaveContext):
+    """
+    Holding registers of one dimming module. Writing the enable (25) or flux (38) register
+    updates the reported percentage (256) and power (257-258) like the real module does.
+    Every request waits `latency` +- `jitter` seconds; `failure_rate` of the requests get an
+    exception response and `timeout_rate` of them never get an answer.
+    """
+
+    def __init__(self, mflux=1000, watts_at_full=600, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 timeout_rate=0.0):
+        super().__init__(hr=ModbusSequentialDataBlock(0, [0] * 300), zero_mode=True)
+        self.mflux = mflux
+        self.watts_at_full = watts_at_full
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.requests = 0
+        self.setValues(3, GUARD_REGISTER, [1])
+
+    def _update_outputs(self):
+        enabled = self.getValues(3, ENABLE_REGISTER)[0] == 1
+        flux = self.getValues(3, FLUX_REGISTER)[0] if enabled else self.mflux
+        percentage = min(100, flux * 100 // self.mflux)
+        power = self.watts_at_full * percentage // 100
+        self.setValues(3, PERCENTAGE_REGISTER, [percentage, power >> 16, power & 0xFFFF])
+
+    async def _serve_delay(self):
+        # Latency, jitter and injected failures, applied once per request.
+        self.requests += 1
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        if delay:
+            await asyncio.sleep(delay)
+        draw = random.random()
+        if draw < self.timeout_rate:
+            await asyncio.sleep(3600)  # the client times out, the request is never answered
+        if draw < self.timeout_rate + self.failure_rate:
+            raise RuntimeError("simulated module failure")
+
+    async def async_getValues(self, fc_as_hex, address, count=1):
+        # A write request reads back the written value, that is not a separate round trip
+        if fc_as_hex in READ_FUNCTION_CODES:
+            await self._serve_delay()
+        return self.getValues(fc_as_hex, address, count)
+
+    async def async_setValues(self, fc_as_hex, address, values):
+        await self._serve_delay()
+        self.setValues(fc_as_hex, address, values)
+        if address <= FLUX_REGISTER and address + len(values) > ENABLE_REGISTER:
+            self._update_outputs()
+
+
+class SimulatedGateway:
+    """
+    Modbus TCP gateway with `slaves` simulated modules (ids 1..slaves), served from a background
+    thread. Port 0 picks a free port, available as `port` once start() returns.
+    """
+
+    def __init__(self, slaves=8, host="127.0.0.1", port=0, **module_options):
+        self.host = host
+        self.port = port
+        self.modules = {slave_id: SimulatedModule(**module_options) for slave_id in range(1, slaves + 1)}
+        self.context = ModbusServerContext(slaves=self.modules, single=False)
+        self.request_count = 0  # every Modbus request received, i.e. round trips
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def _trace(self, request, *addr):
+        self.request_count += 1
+
+    async def _serve(self):
+        self._server = ModbusTcpServer(self.context, address=(self.host, self.port), request_tracer=self._trace)
+        await self._server.listen()
+        self.port = self._server.transport.sockets[0].getsockname()[1]
+        self._started.set()
+        await self._server.serving
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_until_complete, args=(self._serve(),),
+                                        name="simulated-gateway", daemon=True)
+        self._thread.start()
+        if not self._started.wait(5):
+            raise RuntimeError("Simulated gateway did not start")
+        logging.info(f"Simulated gateway with {len(self.modules)} slaves on {self.host}:{self.port}")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            asyncio.run_coroutine_threadsafe(self._server.shutdown(), self._loop).result(5)
+            self._thread.join(5)
+            self._server = None
+
+    def take_request_count(self):
+        # Requests received since the last call.
+        count, self.request_count = self.request_count, 0
+        return count
+
+
+def default_limits_rows(zones=8, par_step=150, import_kw=500, import_limit_mw="1,5", export_kw=100,
+                        export_limit_mw="2,0"):
+    """
+    Limits table shaped like the real API: row 0 header, rows 1..zones [name, PAR, 5 limits],
+    row 9 linear import [name, kW, -, limit MW] and row 10 linear export.
+    """
+    rows = [["zone", "PAR", "l1", "l2", "l3", "l4", "l5"]]
+    rows += [[f"Zone {i}", par_step * i, 100, 300, 500, 700, 900] for i in range(1, zones + 1)]
+    rows += [["filler"]] * (9 - len(rows))
+    rows.append(["Linear import", import_kw, None, import_limit_mw])
+    rows.append(["Linear export", export_kw, None, export_limit_mw])
+    return rows
+
+
+class LimitsApiStub:
+    """
+    HTTP server returning {"rows": rows} with an ETag, answering conditional requests with 304.
+    `latency` seconds are added to every request; `fail` makes it answer 503.
+    """
+
+    def __init__(self, rows=None, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.fail = False
+        self.request_count = 0
+        self._rows = None
+        self._body = None
+        self._etag = None
+        self.set_rows(rows if rows is not None else default_limits_rows())
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.request_count += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.fail:
+                    self.send_error(503)
+                    return
+                body, etag = stub._body, stub._etag
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Limits API stub: {format % args}")
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self._httpd.server_address[1]}/"
+        self._thread = None
+
+    @property
+    def rows(self):
+        return self._rows
+
+    def set_rows(self, rows):
+        # Publish a new table, clients holding the old ETag get it on their next request.
+        self._rows = rows
+        self._body = json.dumps({"rows": rows}).encode()
+        self._etag = f'"{hash(self._body) & 0xFFFFFFFF:08x}"'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="limits-api-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,51 @@
+import numpy as np
+
+from curves import DimmingCurve
+
+
+def interpolate_percentage(par_value, limits, base_percentages):
+    # The scalar interpolation auto control used before DimmingCurve, kept as the reference
+    if par_value <= limits[0]:
+        return 100
+    for i in range(1, len(limits)):
+        if limits[i - 1] < par_value <= limits[i]:
+            x0, y0 = limits[i - 1], base_percentages[i - 1]
+            x1, y1 = limits[i], base_percentages[i]
+            return y0 + (par_value - x0) * (y1 - y0) / (x1 - x0)
+    return 20
+
+
+def random_zones(rng, zones=20000):
+    # Sorted limits with repeated values, PAR values below, between, on and above the limits
+    limits = np.sort(rng.integers(0, 1000, size=(zones, 5)), axis=1)
+    par = rng.integers(-50, 1100, size=zones)
+    on_limit = rng.random(zones) < 0.2
+    par[on_limit] = limits[on_limit, rng.integers(0, 5, size=on_limit.sum())]
+    return par, limits
+
+
+def test_linear_curve_matches_scalar_interpolation():
+    rng = np.random.default_rng(1)
+    par, limits = random_zones(rng)
+    percentages = [100, 80, 60, 40, 20]
+    values = DimmingCurve(percentages).evaluate(par, limits)
+    expected = [interpolate_percentage(p, zone, percentages) for p, zone in zip(par.tolist(), limits.tolist())]
+    np.testing.assert_allclose(values, expected)
+    # auto control truncates to whole percent
+    assert [int(value) for value in values.tolist()] == [int(value) for value in expected]
+
+
+def test_curve_table_matches_direct_evaluation():
+    rng = np.random.default_rng(2)
+    for shape in ("linear", "smoothstep", "step"):
+        curve = DimmingCurve([100, 70, 50, 30, 20], shape=shape)
+        par, limits = random_zones(rng, zones=200)
+        table = curve.compile(limits)
+        assert table.matches(limits)
+        # Integral PAR values come from the table, the others are evaluated directly
+        for par_values in (par, par + 0.5):
+            np.testing.assert_array_equal(table.evaluate(par_values), curve.evaluate(par_values, limits))
+
+
+def test_empty_input():
+    assert DimmingCurve().evaluate([], np.empty((0, 5))).size == 0
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from device_cache import DeviceStateCache
+from fleet import Gateway
+from modbus_engine import FLUX_REGISTER, AsyncModbusEngine, CircuitOpenError
+from simulator import SimulatedGateway
+
+
+@pytest.fixture
+def simulator():
+    gateway = SimulatedGateway(slaves=3).start()
+    yield gateway
+    gateway.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def run(engine, coro):
+    return engine.submit(coro).result(10)
+
+
+def test_breaker_opens_after_threshold_and_skips_the_slave(simulator):
+    engine = AsyncModbusEngine(simulator.host, simulator.port, timeout=0.2, retries=0, breaker_threshold=2,
+                               probe_delay=60)
+    try:
+        simulator.modules[3].timeout_rate = 1
+        results = run(engine, engine.write_all_async([1, 2, 3], "flux", 500))
+        assert [results[slave_id].success for slave_id in (1, 2, 3)] == [True, True, False]
+        assert engine.is_available(3)  # one unanswered request, below the threshold
+        run(engine, engine.write_all_async([3], "flux", 500))
+        assert not engine.is_available(3)
+        # Skipped without a request while the healthy slaves complete
+        requests = simulator.modules[3].requests
+        results = run(engine, engine.write_all_async([1, 2, 3], "flux", 600))
+        assert [results[slave_id].success for slave_id in (1, 2)] == [True, True]
+        assert isinstance(results[3].error, CircuitOpenError)
+        assert simulator.modules[3].requests == requests
+    finally:
+        engine.close()
+
+
+def test_probe_closes_the_breaker_and_forgets_the_cached_state(simulator):
+    cache = DeviceStateCache()
+    engine = AsyncModbusEngine(simulator.host, simulator.port, timeout=0.2, retries=0, cache=cache,
+                               breaker_threshold=1, probe_delay=0.2)
+    try:
+        simulator.modules[3].timeout_rate = 1
+        run(engine, engine.write_all_async([3], "flux", 500))
+        assert not engine.is_available(3)
+        cache.update(3, FLUX_REGISTER, 500)
+        simulator.modules[3].timeout_rate = 0
+        assert wait_for(lambda: engine.is_available(3))
+        assert cache.last_known(3, FLUX_REGISTER) is None
+        assert run(engine, engine.write_all_async([3], "flux", 500))[3].success
+    finally:
+        engine.close()
+
+
+def test_stopped_gateway_is_unreachable_until_it_is_back(simulator):
+    gateway = Gateway("gw", simulator.host, simulator.port, timeout=0.2, retries=0)
+    try:
+        assert run(gateway.engine, gateway.engine.write_all_async([1], "enable", 1))[1].success
+        assert gateway.slave_status(1) == "modbus"
+        simulator.stop()
+        run(gateway.engine, gateway.engine.write_all_async([1], "flux", 500))  # finds the connection gone
+        results = run(gateway.engine, gateway.engine.write_all_async([1, 2], "flux", 500))
+        assert not any(result.success for result in results.values())
+        assert gateway.slave_status(1) == "unreachable"
+        restarted = SimulatedGateway(slaves=3, port=simulator.port).start()
+        try:
+            # Reconnected by the background probe, with the device state cache cleared
+            assert wait_for(lambda: gateway.slave_status(1) != "unreachable")
+            assert gateway.slave_status(1) == "local"
+            assert run(gateway.engine, gateway.engine.write_all_async([1], "flux", 500))[1].success
+        finally:
+            restarted.stop()
+    finally:
+        gateway.engine.close()
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from notifications import MemoryBackend, NotificationDispatcher
+
+
+def dispatcher(backend, **options):
+    options.setdefault("min_interval", 0)
+    options.setdefault("backoff", 0.01)
+    return NotificationDispatcher(backend, **options)
+
+
+def test_alert_is_sent_once_per_episode_and_recovery_ends_it():
+    backend = MemoryBackend()
+    notifier = dispatcher(backend)
+    assert notifier.alert("grid_limit", "over")
+    assert not notifier.alert("grid_limit", "over")
+    assert notifier.recover("grid_limit", "back")
+    assert not notifier.recover("grid_limit", "back")
+    assert notifier.alert("grid_limit", "over again")
+    notifier.flush(2)
+    assert backend.sent == ["over", "back", "over again"]
+    notifier.close()
+
+
+def test_dropped_alert_is_sent_on_the_next_call():
+    backend = MemoryBackend()
+    release = threading.Event()
+    send = backend.send
+    backend.send = lambda text: release.wait(2) and send(text)
+    notifier = dispatcher(backend, max_queue=1)
+    notifier.notify("busy")  # taken by the sender thread, which blocks
+    deadline = time.monotonic() + 2
+    while notifier._queue.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    notifier.notify("queued")
+    assert not notifier.alert("grid_limit", "over")
+    assert notifier.dropped == 1
+    release.set()
+    notifier.flush(2)
+    assert notifier.alert("grid_limit", "over")
+    notifier.flush(2)
+    assert backend.sent == ["busy", "queued", "over"]
+    notifier.close()
+
+
+def test_failed_attempts_back_off_without_waiting_for_the_rate_limit():
+    backend = MemoryBackend()
+    backend.fail = 2
+    notifier = dispatcher(backend, min_interval=30, retries=3, backoff=0.05)
+    started = time.monotonic()
+    notifier.notify("over")
+    assert notifier.flush(5)
+    elapsed = time.monotonic() - started
+    # Two failures: 0.05 s and 0.1 s of backoff, not two rate limit intervals
+    assert backend.sent == ["over"]
+    assert 0.15 <= elapsed < 2
+    notifier.close(timeout=0)
+
+
+def test_message_is_given_up_after_the_retries():
+    backend = MemoryBackend()
+    backend.fail = 10
+    notifier = dispatcher(backend, retries=2)
+    notifier.notify("over")
+    assert notifier.flush(2)
+    assert backend.sent == []
+    assert backend.fail == 7
+    notifier.close()
@@ -0,0 +1,77 @@
+import os
+
+from power_store import PowerStore, RingBuffer
+
+DAY = 86400
+T0 = 1717200000.0  # 2024-06-01 00:00 UTC
+
+
+class Clock:
+    def __init__(self):
+        self.now = T0
+
+    def __call__(self):
+        return self.now
+
+
+def store(path, **options):
+    clock = Clock()
+    return PowerStore(str(path), flush_seconds=3600, clock=clock, **options), clock
+
+
+def test_ring_buffer_keeps_the_newest_samples_in_order():
+    buffer = RingBuffer(4)
+    for i in range(6):
+        buffer.append(i, i * 10)
+    times, values = buffer.latest()
+    assert times.tolist() == [2, 3, 4, 5]
+    assert values.tolist() == [20, 30, 40, 50]
+    assert buffer.latest(2)[0].tolist() == [4, 5]
+    assert buffer.latest(10)[0].tolist() == [2, 3, 4, 5]
+
+
+def test_flushed_samples_are_found_by_a_new_store(tmp_path):
+    powers, _ = store(tmp_path)
+    powers.record(("gw", 1), 100, T0)
+    powers.record(("gw", 2), 200, T0 + 1)
+    powers.record(("gw", 2), 210, T0 + 2)
+    assert powers.query(("gw", 2), T0, T0 + 10, "raw")["watts"].tolist() == [200, 210]  # from the buffer
+    powers.flush()
+    reopened, _ = store(tmp_path)
+    # slaves.json keeps the slave ids, a new slave gets the next one
+    reopened.record(("gw", 3), 300, T0 + 3)
+    assert reopened.query(("gw", 2), T0, T0 + 10, "raw")["watts"].tolist() == [200, 210]
+    assert reopened.query(("gw", 1), T0, T0 + 10, "raw")["watts"].tolist() == [100]
+    assert reopened.query(("gw", 3), T0, T0 + 10, "raw")["watts"].tolist() == [300]
+    assert reopened.query(("gw", 4), T0, T0 + 10, "raw").size == 0
+
+
+def test_rollups_hold_completed_buckets_and_close_writes_the_open_ones(tmp_path):
+    powers, _ = store(tmp_path)
+    for offset, watts in [(0, 100), (30, 300), (60, 200)]:
+        powers.record(("gw", 1), watts, T0 + offset)
+    minutes = powers.query(("gw", 1), T0, T0 + DAY, "1m")
+    assert minutes["time"].tolist() == [T0]
+    assert (minutes["count"][0], minutes["mean"][0], minutes["min"][0], minutes["max"][0]) == (2, 200, 100, 300)
+    assert powers.query(("gw", 1), T0, T0 + DAY, "15m").size == 0
+    powers.close()
+    reopened, _ = store(tmp_path)
+    minutes = reopened.query(("gw", 1), T0, T0 + DAY, "1m")
+    assert minutes["time"].tolist() == [T0, T0 + 60]
+    assert minutes["count"].tolist() == [2, 1]
+    quarter = reopened.query(("gw", 1), T0, T0 + DAY, "15m")
+    assert (quarter["count"].tolist(), quarter["mean"].tolist()) == ([3], [200])
+
+
+def test_day_files_past_their_retention_are_removed(tmp_path):
+    powers, clock = store(tmp_path, retention_days={"raw": 2})
+    powers.record(("gw", 1), 100, T0 - 3 * DAY)
+    powers.record(("gw", 1), 110, T0 - 2 * DAY)
+    powers.close()
+    assert sorted(os.listdir(tmp_path / "raw")) == ["20240530.bin"]
+    assert sorted(os.listdir(tmp_path / "1m")) == ["20240529.bin", "20240530.bin"]
+    # Pruned again on the first flush of a new day
+    clock.now = T0 + DAY
+    powers.record(("gw", 1), 120, clock.now)
+    powers.flush()
+    assert sorted(os.listdir(tmp_path / "raw")) == ["20240602.bin"]
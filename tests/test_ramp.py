@@ -0,0 +1,134 @@
+import threading
+
+from modbus_engine import SlaveResult
+from ramp import RampEngine
+
+
+class FakeCache:
+    def __init__(self):
+        self.flux = {}
+
+    def last_known(self, slave_id, address):
+        return self.flux.get(slave_id)
+
+
+class FakeGateway:
+    def __init__(self):
+        self.cache = FakeCache()
+
+
+class FakeFleet:
+    # Records the flux writes and keeps the last written flux in the gateway caches.
+    def __init__(self, *gateway_names):
+        self.gateways = {name: FakeGateway() for name in gateway_names}
+        self.writes = []
+        self.write_started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def _write(self, slave_flux):
+        self.writes.append(dict(slave_flux))
+        for (gateway_name, slave_id), flux in slave_flux.items():
+            self.gateways[gateway_name].cache.flux[slave_id] = flux
+        return {key: SlaveResult(key[1], True, flux=flux) for key, flux in slave_flux.items()}
+
+    def apply_flux_all(self, slave_flux):
+        return self._write(slave_flux)
+
+    def write_each(self, name, values):
+        self.write_started.set()
+        self.release.wait(5)
+        return self._write(values)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def engine(fleet, **options):
+    clock = Clock()
+    return RampEngine(fleet, clock=clock, background=False, **options), clock
+
+
+def test_budget_per_gateway_goes_to_the_slaves_furthest_behind():
+    fleet = FakeFleet("a", "b")
+    ramps, clock = engine(fleet, writes_per_second=2)
+    for key in [("a", 1), ("a", 2), ("a", 3), ("b", 1)]:
+        fleet.gateways[key[0]].cache.flux[key[1]] = 0
+    ramps.start({("a", 1): 1000, ("a", 2): 500, ("a", 3): 200, ("b", 1): 100}, duration=10)
+    clock.now = 5
+    ramps.step(clock.now)
+    assert fleet.writes[-1] == {("a", 1): 500, ("a", 2): 250, ("b", 1): 50}
+    # Half a second refills one write per gateway, ("a", 3) left out above is now the furthest behind
+    clock.now = 5.5
+    assert ramps.plan_writes(clock.now) == {("a", 3): 110, ("b", 1): 55}
+
+
+def test_small_steps_wait_until_the_ramp_ends():
+    fleet = FakeFleet("a")
+    ramps, clock = engine(fleet, min_step=5)
+    fleet.gateways["a"].cache.flux[1] = 0
+    ramps.start({("a", 1): 3}, duration=10)
+    clock.now = 5
+    assert ramps.plan_writes(clock.now) == {}
+    clock.now = 10
+    assert ramps.plan_writes(clock.now) == {("a", 1): 3}
+
+
+def test_new_target_continues_from_the_flux_written():
+    fleet = FakeFleet("a")
+    ramps, clock = engine(fleet)
+    fleet.gateways["a"].cache.flux[1] = 0
+    ramps.start({("a", 1): 1000}, duration=10)
+    clock.now = 5
+    assert ramps.step(clock.now)
+    assert fleet.writes[-1] == {("a", 1): 500}
+    # The first step of the new ramp holds the current flux, then it fades from there
+    ramps.start({("a", 1): 200}, duration=10)
+    assert fleet.writes[-1] == {("a", 1): 500}
+    clock.now = 10
+    ramps.step(clock.now)
+    assert fleet.writes[-1] == {("a", 1): 350}
+    clock.now = 15
+    assert not ramps.step(clock.now)
+    assert fleet.writes[-1] == {("a", 1): 200}
+    assert ramps.ramps == {}
+
+
+def test_same_target_keeps_the_running_ramp():
+    fleet = FakeFleet("a")
+    ramps, clock = engine(fleet)
+    fleet.gateways["a"].cache.flux[1] = 0
+    ramps.start({("a", 1): 1000}, duration=10)
+    ramp = ramps.ramps[("a", 1)]
+    clock.now = 5
+    ramps.step(clock.now)
+    ramps.start({("a", 1): 1000}, duration=10)
+    assert ramps.ramps[("a", 1)] is ramp
+
+
+def test_cancel_returns_after_the_write_in_flight_and_nothing_is_written_after():
+    fleet = FakeFleet("a")
+    ramps, clock = engine(fleet)
+    fleet.gateways["a"].cache.flux[1] = 0
+    ramps.start({("a", 1): 1000}, duration=10)
+    clock.now = 5
+    fleet.release.clear()
+    ticking = threading.Thread(target=ramps.step, args=(clock.now,))
+    ticking.start()
+    assert fleet.write_started.wait(5)
+    cancelling = threading.Thread(target=ramps.cancel)
+    cancelling.start()
+    cancelling.join(0.2)
+    assert cancelling.is_alive()  # waits for the write in flight
+    fleet.release.set()
+    cancelling.join(5)
+    ticking.join(5)
+    writes = len(fleet.writes)
+    clock.now = 8
+    assert not ramps.step(clock.now)
+    assert len(fleet.writes) == writes
@@ -0,0 +1,39 @@
+import asyncio
+
+from register_map import REGISTERS, Register, plan_reads, read_values_async
+
+
+def blocks(plan):
+    return [(block.address, block.count, [register.name for register in block.registers]) for block in plan]
+
+
+def test_registers_within_max_gap_share_a_block():
+    assert blocks(plan_reads(["power", "percentage"])) == [(256, 3, ["percentage", "power"])]
+    # enable (25) and flux (38) are 12 registers apart
+    assert blocks(plan_reads(["flux", "enable"])) == [(25, 1, ["enable"]), (38, 1, ["flux"])]
+    assert blocks(plan_reads(["flux", "enable"], max_gap=12)) == [(25, 14, ["enable", "flux"])]
+
+
+def test_blocks_are_split_at_max_count():
+    register_map = {f"r{i}": Register(f"r{i}", 10 * i, width=2) for i in range(5)}
+    plan = plan_reads(register_map, register_map, max_gap=10, max_count=22)
+    assert blocks(plan) == [(0, 22, ["r0", "r1", "r2"]), (30, 12, ["r3", "r4"])]
+
+
+def test_two_word_values_are_high_word_first():
+    assert REGISTERS["power"].decode([1, 2]) == 65538
+    assert Register("signed", 0, width=2, signed=True).decode([0xFFFF, 0xFFFE]) == -2
+    assert Register("scaled", 0, scale=0.1).decode([250]) == 25.0
+
+
+def test_read_values_decodes_every_block():
+    memory = {25: 1, 38: 700, 256: 70, 257: 0, 258: 420}
+    reads = []
+
+    async def read(address, count):
+        reads.append((address, count))
+        return [memory.get(address + i, 0) for i in range(count)]
+
+    values = asyncio.run(read_values_async(read, ["enable", "flux", "percentage", "power"]))
+    assert values == {"enable": 1, "flux": 700, "percentage": 70, "power": 420}
+    assert reads == [(25, 1), (38, 1), (256, 3)]
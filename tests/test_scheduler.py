@@ -0,0 +1,98 @@
+from modbus_engine import CircuitOpenError, SlaveResult
+from scheduler import AdaptiveScheduler
+
+KEYS = [("gw", 1), ("gw", 2)]
+LIMITS = [100, 300, 500, 700, 900]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def plan(scheduler, percentage, breach=False):
+    return scheduler.plan(dict.fromkeys(KEYS, percentage), dict.fromkeys(KEYS, (400, LIMITS)), breach)
+
+
+def test_unchanged_inputs_are_not_replanned():
+    clock = Clock()
+    scheduler = AdaptiveScheduler(clock=clock)
+    assert plan(scheduler, 50) == dict.fromkeys(KEYS, 50)
+    clock.now += 15
+    assert plan(scheduler, 50) == {}
+
+
+def test_failed_write_is_planned_again_on_next_poll():
+    clock = Clock()
+    scheduler = AdaptiveScheduler(clock=clock)
+    planned = plan(scheduler, 50)
+    scheduler.forget_failed({KEYS[0]: SlaveResult(1, False, error=TimeoutError()),
+                             KEYS[1]: SlaveResult(2, True, flux=500)})
+    clock.now += 15
+    assert plan(scheduler, 50) == {KEYS[0]: planned[KEYS[0]]}
+    clock.now += 15
+    assert plan(scheduler, 50) == {}
+
+
+def test_failed_breach_reduction_is_retried():
+    clock = Clock()
+    scheduler = AdaptiveScheduler(clock=clock)
+    plan(scheduler, 50)
+    clock.now += 15
+    assert plan(scheduler, 45, breach=True) == dict.fromkeys(KEYS, 45)
+    scheduler.forget_failed({KEYS[1]: SlaveResult(2, False, error=TimeoutError())})
+    clock.now += 15
+    assert plan(scheduler, 45, breach=True) == {KEYS[1]: 45}
+
+
+def test_slave_skipped_by_its_breaker_is_left_to_the_probe():
+    clock = Clock()
+    scheduler = AdaptiveScheduler(clock=clock)
+    plan(scheduler, 50)
+    scheduler.forget_failed({KEYS[0]: SlaveResult(1, False, error=CircuitOpenError("skipped"))})
+    clock.now += 15
+    assert plan(scheduler, 50) == {}
+
+
+def auto_control(errors):
+    # ControlCore on the replay stand-ins with an apply() failing slave 1 with errors[poll]
+    from control_core import ControlCore, load_config
+    from replay import ReplaySnapshot, SimulatedFleet, VirtualClock
+    from simulator import default_limits_rows
+
+    config = load_config()
+    config["gateways"] = [{"name": "gw", "slaves": [{"id": 1, "api_row": 1}, {"id": 2, "api_row": 2}]}]
+    clock = VirtualClock(0.0)
+    core = ControlCore(config, fleet=SimulatedFleet.from_config(config),
+                       api_snapshot=ReplaySnapshot([(0.0, default_limits_rows())], clock))
+    scheduler = core.create_scheduler(clock=clock)
+    applied = []
+    cycles = []
+
+    def apply(percentages, ramp_seconds=0, on_results=None):
+        applied.append(set(percentages))
+        error = errors[len(applied) - 1]
+        on_results({key: SlaveResult(key[1], key[1] != 1, error=error if key[1] == 1 else None)
+                    for key in percentages})
+
+    for poll in range(len(errors)):
+        clock.now = poll * 15.0
+        core.auto_control_step(scheduler, apply, on_cycle=cycles.append)
+    core.close()
+    return applied, cycles
+
+
+def test_auto_control_step_retries_failed_slaves():
+    applied, cycles = auto_control([TimeoutError()] * 3)
+    assert applied == [set(KEYS), {KEYS[0]}, {KEYS[0]}]
+    assert cycles == [1, 2, 3]
+
+
+def test_auto_control_step_does_not_count_skipped_slaves():
+    # Only slave 1 is planned on the second poll, and its breaker opened: nothing was written
+    applied, cycles = auto_control([TimeoutError(), CircuitOpenError("skipped"), None])
+    assert applied == [set(KEYS), {KEYS[0]}]
+    assert cycles == [1]